@@ -0,0 +1,51 @@
+import numpy as np
+
+ARENA_UNITS = {"K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30, "T": 2 ** 40}
+ARENA_BUDGET = 2 ** 30
+
+
+def parse_size(value):
+    # Sizes are given in bytes or with a binary
+    # unit suffix, e.g. '512M' or '2G'
+    value = value.strip().upper().removesuffix("B")
+    if value and value[-1] in ARENA_UNITS:
+        return int(float(value[:-1]) * ARENA_UNITS[value[-1]])
+
+    return int(value)
+
+
+class BufferArena:
+    def __init__(self, max_memory=0):
+        # Work buffers are kept by name and handed out again
+        # for later stages and images instead of allocating
+        # fresh arrays. Buffers only grow, so that images of
+        # equal or smaller size reuse them as they are. Without
+        # a budget, no buffers are kept at all.
+        self.max_memory = max_memory
+        self.buffers = dict()
+        self.size = 0
+        self.overflow = 0
+
+    def get(self, name, shape, dtype):
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        buffer = self.buffers.get(name)
+        if buffer is None or len(buffer) < nbytes:
+            # Buffers that would exceed the budget are
+            # allocated for this use only and not kept
+            size = self.size - (0 if buffer is None else len(buffer)) + nbytes
+            if self.max_memory <= 0:
+                return np.empty(shape, dtype=dtype)
+            if size > self.max_memory:
+                self.overflow += nbytes
+                return np.empty(shape, dtype=dtype)
+
+            # The outgrown buffer is released
+            # before its successor is allocated
+            self.buffers.pop(name, None)
+            del buffer
+            buffer = np.empty(nbytes, dtype=np.uint8)
+            self.buffers[name] = buffer
+            self.size = size
+
+        return buffer[:nbytes].view(dtype).reshape(shape)
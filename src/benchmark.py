@@ -4,8 +4,9 @@ import numpy as np
 import json
 import cv2
 
+from colorspace import ChannelOrder, to_channel_order
 from export import *
-from plygn import load_image
+from loading import load_image, RawDecoding
 from utils import *
 from enum import Enum, auto
 from pytorch_msssim import ms_ssim
@@ -27,8 +28,15 @@ class MeasurementType(Enum):
     COMPARATIVE = auto()
 
 
-def get_numpy_image(input):
-    _, image = load_image(input)
+def get_numpy_image(input, raw_decoding=RawDecoding.FULL):
+    _, image, order = load_image(input, raw_decoding)
+    return to_numpy_image(image, order)
+
+
+def to_numpy_image(image, order):
+    # Originals and results may be stored in different
+    # channel orders, so both are compared in RGB
+    image = to_channel_order(np.asarray(image), order, ChannelOrder.RGB)
     image = np.transpose(image, (2, 0, 1))
     image = np.expand_dims(image, axis=0)
     image = image.astype(np.float32)
@@ -44,12 +52,13 @@ def get_pixel_size(image):
     return height * width
 
 
-def get_measurement_reference(input, original_size, original_mem, processing_time, total_time):
+def get_measurement_reference(input, original_size, original_mem, processing_time, total_time, analysis_scale):
     reference = {
         "path_original": input,
         "size_original": original_mem,
         "time_processing": processing_time,
         "time_total": total_time,
+        "analysis_scale": analysis_scale,
         "bpp": (original_mem / original_size)
     }
     return reference
@@ -110,6 +119,24 @@ def get_impact(processed_measurement, unprocessed_measurement):
     return impact
 
 
+def get_pyramid_cost(original, order, analysed, full_resolution, processing_time, full_resolution_time):
+    # Results of the downscaled analysis are compared to those
+    # of a full-resolution analysis before being encoded, so
+    # that the cost of pyramid mode is reported by itself
+    print("> Pyramid Cost:")
+    original_image = to_numpy_image(original, order)
+    analysed_psnr, analysed_msssim = measure(original_image, to_numpy_image(analysed, order))
+    full_psnr, full_msssim = measure(original_image, to_numpy_image(full_resolution, order))
+
+    cost = {
+        "psnr": analysed_psnr - full_psnr,
+        "msssim": analysed_msssim - full_msssim,
+        "time_processing_full_resolution": full_resolution_time,
+        "speedup": full_resolution_time / processing_time if processing_time > 0 else None
+    }
+    return cost
+
+
 def get_format_entry(output, format, measurement_type, original_image):
     format_suffix = str(format).lower()
     path_template = f"{output}_{{0}}.{format_suffix}"
@@ -132,14 +159,17 @@ def get_format_entry(output, format, measurement_type, original_image):
     return format_entry
 
 
-def get_benchmark_entry(input, output, formats, measurement_type, processing_time, total_time):
+def get_benchmark_entry(input, output, formats, measurement_type, processing_time, total_time, analysis_scale=1,
+                        raw_decoding=RawDecoding.FULL):
     print("\nBenchmarking:")
-    original_image = get_numpy_image(input)
+    # RAW originals are decoded the same way as for processing,
+    # so that dimensions match those of the results
+    original_image = get_numpy_image(input, raw_decoding)
     original_size = get_pixel_size(original_image)
     original_mem = os.path.getsize(input)
     benchmark_entry = {}
 
-    reference = get_measurement_reference(input, original_size, original_mem, processing_time, total_time)
+    reference = get_measurement_reference(input, original_size, original_mem, processing_time, total_time, analysis_scale)
     benchmark_entry["reference"] = reference
 
     for format in formats:
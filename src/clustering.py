@@ -1,26 +1,86 @@
 import faiss
 import numpy as np
 
+from enum import Enum
+
 KMEANS_ITERATIONS = 100
 KMEANS_RUNS = 10
+PALETTE_SAMPLES = 16
+
+
+class PaletteMode(Enum):
+    INDEPENDENT = 'INDEPENDENT'
+    SHARED = 'SHARED'
+    WARM = 'WARM'
+
+    def __str__(self):
+        return self.value
+
+
+def fit_palette(clusters, points, weights, init=None):
+    # Starting from given centroids (e.g. those of a previous
+    # frame) converges quickly, so a single run is sufficient
+    runs = KMEANS_RUNS if init is None else 1
+    process = faiss.Kmeans(d=points.shape[1], k=clusters, niter=KMEANS_ITERATIONS, nredo=runs)
+    process.train(points, weights, init_centroids=init)
+    return process.centroids
+
+
+def find_palette(mode, clusters, points, weights, codebook=None):
+    # A codebook shared by a batch is either used as it is,
+    # so that only labels are assigned per image, or it is
+    # the starting point for fitting the image's own palette
+    if codebook is None or len(codebook) != clusters:
+        return fit_palette(clusters, points, weights)
+
+    match mode:
+        case PaletteMode.SHARED:
+            return codebook
+        case PaletteMode.WARM:
+            return fit_palette(clusters, points, weights, codebook)
+        case _:
+            return fit_palette(clusters, points, weights)
+
+
+def assign_labels(centroids, points):
+    # Each point is labeled with
+    # its closest palette centroid
+    index = faiss.IndexFlatL2(centroids.shape[1])
+    index.add(centroids)
+    labels = index.search(points, 1)[1].ravel()
+    return labels
 
 
 def kmeans(clusters, points, weights):
-    process = faiss.Kmeans(d=points.shape[1], k=clusters, niter=KMEANS_ITERATIONS, nredo=KMEANS_RUNS)
-    process.train(points, weights)
-    labels = process.index.search(points, 1)[1].ravel()
+    centroids = fit_palette(clusters, points, weights)
+    labels = assign_labels(centroids, points)
     return labels
 
 
-def expand_labels(image_as_ints, unique_ints, labels, shape):
+def get_label_dtype(clusters):
+    # Labels are stored in the smallest type holding all
+    # clusters, which shrinks the lookup table and the
+    # label map by four compared to 32-bit integers
+    return np.uint8 if clusters <= 256 else np.uint16
+
+
+def expand_labels(image_as_ints, unique_ints, labels, shape, lookup=None, out=None):
     # Each unique color is represented as an int
     # and is used as an index to its own label.
-    lookup = np.empty((256 ** 3), dtype=np.int32)
+    # Stale entries of a reused lookup table are
+    # never read, as only this image's colors are.
+    dtype = get_label_dtype(int(labels.max()) + 1 if len(labels) > 0 else 1)
+    if lookup is None:
+        lookup = np.empty((256 ** 3), dtype=dtype)
     np.put(lookup, unique_ints, labels)
 
     # Each image pixel is also represented as an int.
     # Its value is used to index the lookup table,
-    # where each unique color stores its label.
+    # where each unique color stores its label. Indices
+    # are in range by construction, so that they are
+    # not checked, which would buffer the output.
     height, width, _ = shape
-    expanded = np.take(lookup, image_as_ints).reshape((height, width))
-    return expanded
+    if out is None:
+        out = np.empty((height, width), dtype=lookup.dtype)
+    np.take(lookup, image_as_ints, out=out.reshape(-1), mode='clip')
+    return out
@@ -4,15 +4,28 @@ import math
 from numba import njit
 
 
-@njit(cache=True, nogil=True)
-def colorize(image, triangulation, variance):
-    canvas = image.copy()
+def colorize(image, triangulation, variance, canvas=None):
+    # The canvas starts out as a copy of the image, which
+    # is optionally written into a given buffer
+    if canvas is None:
+        canvas = np.empty(image.shape, dtype=image.dtype)
+    np.copyto(canvas, image)
+    colorize_into(image, triangulation, variance, canvas)
+    return canvas
+
 
+@njit(cache=True, nogil=True)
+def colorize_into(image, triangulation, variance, canvas):
     # Triangle coordinates are converted to discrete
     # integer values and bounding boxes are calculated.
     triangulation = triangulation.astype(np.int32)
     xmin, ymin, xmax, ymax, width, height = find_bounding_boxes(triangulation)
 
+    # A single byte mask large enough for the largest
+    # bounding box is shared by all triangles
+    areas = width.astype(np.int64) * height.astype(np.int64)
+    mask = np.empty(areas.max() if len(areas) > 0 else 0, dtype=np.uint8)
+
     # Vectorized calculation of only triangle-dependent
     # components for barycentric coordinate calculations
     v0x, v0y, v1x, v1y, inv_den = find_barycentric_components(triangulation)
@@ -40,7 +53,8 @@ def colorize(image, triangulation, variance):
 
         # For each position in the bounding box, that lies within
         # the triangle, a condensed decision variable is set.
-        inside = np.zeros((t_height, t_width))
+        inside = mask[:(t_height * t_width)].reshape((t_height, t_width))
+        inside[:] = 0
         for ix, x in enumerate(range(t_xmin, t_xmax + 1)):
             for iy, y in enumerate(range(t_ymin, t_ymax + 1)):
                 if v[iy][ix] >= 0 and w[iy][ix] >= 0 and u[iy][ix] <= 1:
@@ -96,8 +110,6 @@ def colorize(image, triangulation, variance):
             for iy, y in enumerate(range(t_ymin, t_ymax + 1)):
                 if inside[iy][ix] == 1:
                     canvas[y][x] = color
-                    
-    return canvas
 
 
 @njit(cache=True, nogil=True)
@@ -1,83 +1,120 @@
 import cv2
+import functools
+import hashlib
+import inspect
 import math
 import numpy as np
+import os
 import plotly.express as px
 import plotly.graph_objects as go
+import threading
 
 from enum import Enum
-from numba import njit
+
+LOOKUP_PATH = "{0}/lut_{1}_{2}.npy"
+LOOKUP_CHUNK = 256 ** 2
+LOOKUP_MINIMUM = 2 ** 16
+LOOKUP_TABLES = dict()
+LOOKUP_LOCK = threading.Lock()
+
+# Matrices from linear sRGB to cone responses
+# and from those to OkLab (Björn Ottosson, 2020)
+OKLAB_LMS = np.array([
+    [0.4122214708, 0.5363325363, 0.0514459929],
+    [0.2119034982, 0.6806995451, 0.1073969566],
+    [0.0883024619, 0.2817188376, 0.6299787005]
+], dtype=np.float32)
+OKLAB_LAB = np.array([
+    [0.2104542553, 0.7936177850, -0.0040720468],
+    [1.9779984951, -2.4285922050, 0.4505937099],
+    [0.0259040371, 0.7827717662, -0.8086757660]
+], dtype=np.float32)
+
+PLOT_VOXELS = 32
+PLOT_LIMIT = 20000
 
 
 class ColorSpace(Enum):
     RGB = 'RGB'
     HSV = 'HSV'
     HSL = 'HSL'
+    LAB = 'LAB'
+    OKLAB = 'OKLAB'
+
+    def __str__(self):
+        return self.value
+
+
+class ChannelOrder(Enum):
+    RGB = 'RGB'
+    BGR = 'BGR'
+
+    def __str__(self):
+        return self.value
+
+
+class PlotFormat(Enum):
+    VIEWER = 'VIEWER'
+    HTML = 'HTML'
+    PNG = 'PNG'
 
     def __str__(self):
         return self.value
 
 
-def dedupe_colors(image):
-    # Transform color channels (R, G, B)
-    # into integers for faster differentiation
-    r, g, b = cv2.split(image)
-    image_as_ints = (np.int32(b) << 16) + (np.int32(g) << 8) + np.int32(r)
+def to_channel_order(image, source, target):
+    # Images are only converted where really needed,
+    # e.g. when an encoder expects a specific order
+    if source is target:
+        return image
+
+    return cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+
+
+def dedupe_colors(image, order=ChannelOrder.RGB, out=None):
+    # Transform color channels (R, G, B) into integers
+    # for faster differentiation. The integers are the
+    # same, no matter in which order channels are stored.
+    # They are composed in place, optionally into a
+    # given buffer, instead of through temporaries.
+    r, b = (2, 0) if order is ChannelOrder.BGR else (0, 2)
+    image_as_ints = out if out is not None else np.empty(image.shape[:2], dtype=np.int32)
+    image_as_ints[...] = image[..., b]
+    image_as_ints <<= 8
+    image_as_ints |= image[..., 1]
+    image_as_ints <<= 8
+    image_as_ints |= image[..., r]
     image_as_ints = image_as_ints.reshape(-1)
 
     # Determine unique colors (ints)
     # and their frequency
     unique_ints, unique_counts = np.unique(image_as_ints, return_counts=True)
-
-    # Transform color ints back into channels
-    unique_colors = unique_ints.view(np.uint8).reshape(unique_ints.shape + (4,))[..., :3]
+    unique_colors = to_colors(unique_ints)
     return image_as_ints, unique_ints, unique_colors, unique_counts
 
 
-@njit(cache=True, nogil=True)
-def to_hsv_cylinder(pixels):
-    # Transpose pixel matrix and
-    # split into HSL channels
-    length = len(pixels)
-    pixels = np.swapaxes(pixels, 1, 0)
-    h, s, v = pixels.copy()
-
-    # Translate Hue values into
-    # radians and calculate (co)sine
-    h = np.multiply(h, 2 * (math.pi/180))
-    sines = np.sin(h)
-    cosines = np.cos(h)
+def to_colors(color_ints):
+    # Transform color ints back into channels
+    color_ints = np.asarray(color_ints, dtype=np.int32)
+    return color_ints.view(np.uint8).reshape(color_ints.shape + (4,))[..., :3]
 
-    # Calculate HSL coordinates
-    pixels[0] = [s[i] * sines[i] for i in range(length)]
-    pixels[1] = [s[i] * cosines[i] for i in range(length)]
 
-    # Transform pixel matrix back
-    pixels = np.swapaxes(pixels, 1, 0)
-    return pixels
+def to_hsv_cylinder(pixels):
+    # Translate Hue values into radians and place
+    # each color on a cylinder around the value axis
+    h = pixels[:, 0] * (2 * (math.pi / 180))
+    s = pixels[:, 1]
+    v = pixels[:, 2]
+    return np.stack((s * np.sin(h), s * np.cos(h), v), axis=1).astype(np.float32)
 
 
-@njit(cache=True, nogil=True)
 def to_hsl_cylinder(pixels):
-    # Transpose pixel matrix and
-    # split into HSL channels
-    length = len(pixels)
-    pixels = np.swapaxes(pixels, 1, 0)
-    h, l, s = pixels.copy()
-
-    # Translate Hue values into
-    # radians and calculate (co)sine
-    h = np.multiply(h, 2 * (math.pi/180))
-    sines = np.sin(h)
-    cosines = np.cos(h)
-
-    # Calculate HSL coordinates
-    pixels[0] = [s[i] * sines[i] for i in range(length)]
-    pixels[1] = [s[i] * cosines[i] for i in range(length)]
-    pixels[2] = l
-
-    # Transform pixel matrix back
-    pixels = np.swapaxes(pixels, 1, 0)
-    return pixels
+    # Translate Hue values into radians and place
+    # each color on a cylinder around the lightness axis
+    h = pixels[:, 0] * (2 * (math.pi / 180))
+    l = pixels[:, 1]
+    s = pixels[:, 2]
+    return np.stack((s * np.sin(h), s * np.cos(h), l), axis=1).astype(np.float32)
 
 
 def to_hsv(rgb):
@@ -94,23 +131,167 @@ def to_hsl(rgb):
     return hsl
 
 
-def plot(colors, points):
+def to_lab(rgb):
+    # Converting floating point colors yields
+    # CIELAB coordinates in their natural range
+    rgb = np.float32(rgb.reshape((len(rgb), 1, 3))) / 255
+    lab = cv2.cvtColor(rgb, cv2.COLOR_RGB2Lab)
+    return lab.reshape((-1, 3))
+
+
+def to_oklab(rgb):
+    # sRGB values are linearized before being projected into
+    # the OkLab color space, which is scaled to match CIELAB
+    rgb = np.float32(rgb) / 255
+    linear = np.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)
+    lms = np.cbrt(linear @ OKLAB_LMS.T)
+    oklab = (lms @ OKLAB_LAB.T) * 100
+    return oklab.astype(np.float32)
+
+
+def convert_colors(colors, space):
+    match space:
+        case ColorSpace.HSV:
+            return to_hsv_cylinder(to_hsv(colors))
+        case ColorSpace.HSL:
+            return to_hsl_cylinder(to_hsl(colors))
+        case ColorSpace.LAB:
+            return to_lab(colors)
+        case ColorSpace.OKLAB:
+            return to_oklab(colors)
+        case _:
+            return np.float32(colors)
+
+
+@functools.cache
+def get_lookup_version():
+    # Cached tables are identified by the source of the
+    # conversions, their constants and the OpenCV version,
+    # so that changing any of them builds new tables
+    digest = hashlib.blake2b(digest_size=8)
+    for function in (to_hsv_cylinder, to_hsl_cylinder, to_hsv, to_hsl, to_lab, to_oklab, convert_colors):
+        digest.update(inspect.getsource(function).encode("utf-8"))
+    digest.update(OKLAB_LMS.tobytes())
+    digest.update(OKLAB_LAB.tobytes())
+    digest.update(cv2.__version__.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def get_lookup_path(space):
+    cache = os.environ.get("PLYGN_CACHE", os.path.expanduser("~/.cache/plygn"))
+    os.makedirs(cache, exist_ok=True)
+    return LOOKUP_PATH.format(cache, str(space).lower(), get_lookup_version())
+
+
+def build_lookup_table(path, space):
+    # The table holds the translated coordinates of every
+    # 24-bit color, indexed by its color int. It is built
+    # chunk-wise and renamed once complete, so that other
+    # processes never map a partially written table. An
+    # interrupted build removes its partial table.
+    temporary = f"{path}.{os.getpid()}.tmp"
+    try:
+        table = np.lib.format.open_memmap(temporary, mode='w+', dtype=np.float32, shape=(256 ** 3, 3))
+        for start in range(0, 256 ** 3, LOOKUP_CHUNK):
+            color_ints = np.arange(start, start + LOOKUP_CHUNK, dtype=np.int32)
+            table[start:(start + LOOKUP_CHUNK)] = convert_colors(to_colors(color_ints), space)
+
+        table.flush()
+        del table
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+def get_lookup_table(space):
+    with LOOKUP_LOCK:
+        if space not in LOOKUP_TABLES:
+            path = get_lookup_path(space)
+            if not os.path.exists(path):
+                build_lookup_table(path, space)
+            LOOKUP_TABLES[space] = np.load(path, mmap_mode='r')
+
+        return LOOKUP_TABLES[space]
+
+
+def aggregate_voxels(colors, points, counts, voxels):
+    # Each point is assigned to a voxel of a regular grid
+    # spanning the bounding box of the point cloud
+    lower = points.min(axis=0)
+    extent = np.maximum(points.max(axis=0) - lower, 1e-6)
+    cells = np.floor((points - lower) / extent * voxels).astype(np.int64)
+    cells = np.clip(cells, 0, voxels - 1)
+    cells = (cells[:, 0] * voxels + cells[:, 1]) * voxels + cells[:, 2]
+
+    # Positions and colors of a voxel are the averages
+    # of its points weighted by their pixel frequency
+    _, inverse = np.unique(cells, return_inverse=True)
+    weights = np.bincount(inverse, weights=counts)
+    positions = np.stack([np.bincount(inverse, weights=points[:, i] * counts) for i in range(3)], axis=1)
+    averages = np.stack([np.bincount(inverse, weights=colors[:, i] * counts) for i in range(3)], axis=1)
+    return averages / weights[:, None], positions / weights[:, None], weights
+
+
+def plot(colors, points, counts, centroids=None, voxels=PLOT_VOXELS, limit=PLOT_LIMIT, format=None, path=None):
+    # Millions of unique colors are condensed into
+    # voxels, which are weighted by pixel frequency
+    colors = np.float64(colors)
+    points = np.float64(points)
+    counts = np.float64(counts)
+    if voxels > 0:
+        colors, points, counts = aggregate_voxels(colors, points, counts, voxels)
+
+    # Only the heaviest points are rendered,
+    # so that the viewer stays responsive
+    if limit > 0 and len(points) > limit:
+        heaviest = np.argpartition(counts, -limit)[-limit:]
+        colors, points, counts = colors[heaviest], points[heaviest], counts[heaviest]
+
     # Transpose coordinate matrix to read
     # x, y and z coordinates row-wise
     x, y, z = np.swapaxes(points, 1, 0)
-    fig = go.Figure(data=[
+    sizes = 2 + np.log1p(counts) / np.log1p(counts.max()) * 8
+    data = [
         go.Scatter3d(
             x=x,
             y=y,
             z=z,
             mode='markers',
+            name='colors',
             marker=dict(
-                size=3,
-                color=colors,
+                size=sizes,
+                color=[f"rgb({int(r)},{int(g)},{int(b)})" for r, g, b in colors],
+            )
+        )
+    ]
+
+    if centroids is not None:
+        cx, cy, cz = np.swapaxes(centroids, 1, 0)
+        data.append(
+            go.Scatter3d(
+                x=cx,
+                y=cy,
+                z=cz,
+                mode='markers',
+                name='centroids',
+                marker=dict(
+                    size=12,
+                    symbol='diamond',
+                    color='black'
+                )
             )
-        )]
-    )
-    fig.show()
+        )
+
+    fig = go.Figure(data=data)
+    match format:
+        case PlotFormat.HTML:
+            fig.write_html(f"{path}/plot.html", include_plotlyjs='cdn')
+        case PlotFormat.PNG:
+            fig.write_image(f"{path}/plot.png")
+        case _:
+            fig.show()
 
 
 def show(image):
@@ -118,15 +299,14 @@ def show(image):
     figure.show()
 
 
-def to_space(colors, space):
-    match space:
-        case ColorSpace.HSV:
-            data = to_hsv(colors)
-            data = to_hsv_cylinder(data)
-        case ColorSpace.HSL:
-            data = to_hsl(colors)
-            data = to_hsl_cylinder(data)
-        case _:
-            return np.float32(colors)
+def to_space(colors, space, color_ints=None):
+    if space is ColorSpace.RGB:
+        return np.float32(colors)
+
+    # Photos with many unique colors are translated with a
+    # single gather from the cached lookup table, whereas a
+    # few colors are cheaper to convert directly
+    if color_ints is not None and len(color_ints) >= LOOKUP_MINIMUM:
+        return np.take(get_lookup_table(space), color_ints, axis=0)
 
-    return data
+    return convert_colors(colors, space)
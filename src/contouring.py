@@ -1,4 +1,7 @@
 import cv2
+import numpy as np
+
+from colorspace import ChannelOrder, to_channel_order
 
 CONTOUR_THICKNESS = 1
 CONTOUR_COLOR = (255, 0, 255)
@@ -7,20 +10,24 @@ CONTOUR_COLOR = (255, 0, 255)
 def denoise_bitmask(bitmask, kernel_size):
     kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (kernel_size, kernel_size))
 
-    # Remove bitmask islands inside and outside
-    result = cv2.morphologyEx(bitmask, cv2.MORPH_OPEN, kernel)
-    result = cv2.morphologyEx(result, cv2.MORPH_CLOSE, kernel)
-    return result
+    # Remove bitmask islands inside and outside,
+    # writing the result back into the bitmask
+    cv2.morphologyEx(bitmask, cv2.MORPH_OPEN, kernel, dst=bitmask)
+    cv2.morphologyEx(bitmask, cv2.MORPH_CLOSE, kernel, dst=bitmask)
+    return bitmask
 
 
-def find_contours(image, cluster_count, labels, kernel_size):
-    bitmask = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+def find_contours(cluster_count, labels, kernel_size, bitmask=None):
+    # The bitmask is a scratch buffer,
+    # unrelated to the image content
+    if bitmask is None:
+        bitmask = np.empty(labels.shape, dtype=np.uint8)
     contour_groups = list()
     for k in range(cluster_count):
-        # Each bitmask pixel assigned to center k
-        # is marked white, else black
-        bitmask.fill(0)
-        bitmask[labels == k] = 255
+        # Each bitmask pixel assigned to center k is
+        # marked as one, else zero. Comparing into a
+        # boolean view of the bitmask avoids a mask.
+        np.equal(labels, k, out=bitmask.view(np.bool_))
 
         # If a denoise kernel size is given
         # the bitmask gets denoised
@@ -33,26 +40,33 @@ def find_contours(image, cluster_count, labels, kernel_size):
     return contour_groups
 
 
-def export_contours(image, contour_groups, out_path):
-    combined_image = image.copy()
+def restore_region(canvas, image, contour_group):
+    # Only the bounding box of the drawn contours (widened by
+    # the line thickness) is reset from the image
+    if len(contour_group) == 0:
+        return
+
+    height, width = canvas.shape[:2]
+    x, y, w, h = cv2.boundingRect(np.concatenate(contour_group))
+    x0, y0 = max(0, x - CONTOUR_THICKNESS), max(0, y - CONTOUR_THICKNESS)
+    x1, y1 = min(width, x + w + CONTOUR_THICKNESS), min(height, y + h + CONTOUR_THICKNESS)
+    canvas[y0:y1, x0:x1] = image[y0:y1, x0:x1]
+
+
+def export_contours(image, order, contour_groups, out_path):
+    # A single canvas is copied from the image once. After each
+    # cluster, only the region its contours were drawn onto is
+    # restored. It is held in the encoder's BGR order, which the
+    # symmetric contour color does not depend on.
+    image = to_channel_order(image, order, ChannelOrder.BGR)
+    canvas = image.copy()
     for i, contour_group in enumerate(contour_groups):
-        # For each cluster, a separate
-        # output image is computed
-        cluster_specific = image.copy()
-        cv2.drawContours(cluster_specific, contour_group, -1, CONTOUR_COLOR, CONTOUR_THICKNESS)
-
-        cv2.imwrite(
-            f"{out_path}/cluster_{i}.png",
-            cv2.cvtColor(cluster_specific, cv2.COLOR_RGB2BGR)
-        )
-
-        # Each cluster contour is also
-        # written to a combined image
-        cv2.drawContours(combined_image, contour_group, -1, CONTOUR_COLOR, CONTOUR_THICKNESS)
-
-    # After drawing all contours the
-    # combined contour image is exported
-    cv2.imwrite(
-        f"{out_path}/combined.png",
-        cv2.cvtColor(combined_image, cv2.COLOR_RGB2BGR)
-    )
+        cv2.drawContours(canvas, contour_group, -1, CONTOUR_COLOR, CONTOUR_THICKNESS)
+        cv2.imwrite(f"{out_path}/cluster_{i}.png", canvas)
+        restore_region(canvas, image, contour_group)
+
+    # All contours are drawn onto the
+    # combined image in a single call
+    combined_group = [contour for contour_group in contour_groups for contour in contour_group]
+    cv2.drawContours(canvas, combined_group, -1, CONTOUR_COLOR, CONTOUR_THICKNESS)
+    cv2.imwrite(f"{out_path}/combined.png", canvas)
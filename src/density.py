@@ -0,0 +1,61 @@
+import cv2
+import numpy as np
+
+from pyramid import find_gradient_magnitude
+
+DENSITY_FLOOR = 0.25
+DENSITY_SIGMA = 0.02
+DENSITY_PERCENTILE = 99
+
+
+def find_saliency(image, order):
+    # Edge strength, smoothed over a neighbourhood relative to
+    # the image size, is a cheap estimate of how much detail a
+    # region holds and thus of where viewers look at
+    magnitude = np.float32(find_gradient_magnitude(image, order))
+    sigma = max(1.0, max(image.shape[:2]) * DENSITY_SIGMA)
+    saliency = cv2.GaussianBlur(magnitude, (0, 0), sigma)
+
+    # A high percentile is used for normalizing, so
+    # that a few very strong edges do not outweigh
+    # all other detail in the image
+    scale = np.percentile(saliency, DENSITY_PERCENTILE)
+    if scale <= 0:
+        return np.ones(saliency.shape, dtype=np.float32)
+
+    return np.minimum(saliency / scale, 1.0).astype(np.float32)
+
+
+def load_density_map(path, shape):
+    # Masks are grayscale images, in which white marks
+    # regions of interest. They are resized to the image.
+    mask = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if mask is None:
+        raise ValueError(f"Density map '{path}' could not be read")
+
+    height, width = shape[:2]
+    mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_AREA)
+    return np.float32(mask) / 255
+
+
+def find_density(image, order, floor=DENSITY_FLOOR, path=None):
+    # The density scales the vertex and triangle budget of a
+    # region, from the floor in the background up to one in
+    # the most salient regions
+    if path is not None:
+        saliency = load_density_map(path, image.shape)
+    else:
+        saliency = find_saliency(image, order)
+
+    return floor + (1 - floor) * saliency
+
+
+def find_split_thresholds(triangulation, density, threshold, scale=1):
+    # Vertex spacing grows inversely with the density, so
+    # that the area threshold grows with its square. The
+    # density is sampled at each triangle's centroid.
+    height, width = density.shape
+    xs = (triangulation[:, 0] + triangulation[:, 2] + triangulation[:, 4]) // (3 * scale)
+    ys = (triangulation[:, 1] + triangulation[:, 3] + triangulation[:, 5]) // (3 * scale)
+    densities = density[np.clip(ys, 0, height - 1), np.clip(xs, 0, width - 1)]
+    return threshold / np.float64(densities) ** 2
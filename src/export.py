@@ -1,7 +1,12 @@
 import qoi
 import cv2
+import queue
+import threading
+from colorspace import ChannelOrder, to_channel_order
 from enum import Enum
 
+ARTIFACT_QUEUE_SIZE = 4
+
 
 class ExportFormat(Enum):
     JPG = 'JPG'
@@ -12,34 +17,103 @@ class ExportFormat(Enum):
         return self.value
 
 
-def export(path, processed, unprocessed, export_formats, export_unprocessed):
+def export(path, processed, unprocessed, export_formats, export_unprocessed, order, processed_order=None):
+    # OpenCV encoders expect BGR and QOI expects RGB, so that
+    # images are converted at most once for each of them. The
+    # processed image may be stored in an order of its own.
+    # The paths of all written files are returned.
+    processed_order = order if processed_order is None else processed_order
+    outputs = list()
+    if ExportFormat.JPG in export_formats or ExportFormat.PNG in export_formats:
+        processed_bgr = to_channel_order(processed, processed_order, ChannelOrder.BGR)
+        unprocessed_bgr = to_channel_order(unprocessed, order, ChannelOrder.BGR) if export_unprocessed else None
+
     if ExportFormat.JPG in export_formats:
         cv2.imwrite(
             f"{path}_processed.jpg",
-            cv2.cvtColor(processed, cv2.COLOR_RGB2BGR),
+            processed_bgr,
             [int(cv2.IMWRITE_JPEG_QUALITY), 90]
         )
+        outputs.append(f"{path}_processed.jpg")
 
         if export_unprocessed:
             cv2.imwrite(
                 f"{path}_unprocessed.jpg",
-                cv2.cvtColor(unprocessed, cv2.COLOR_RGB2BGR),
+                unprocessed_bgr,
                 [int(cv2.IMWRITE_JPEG_QUALITY), 90]
             )
+            outputs.append(f"{path}_unprocessed.jpg")
 
     if ExportFormat.PNG in export_formats:
         cv2.imwrite(
             f"{path}_processed.png",
-            cv2.cvtColor(processed, cv2.COLOR_RGB2BGR)
+            processed_bgr
         )
+        outputs.append(f"{path}_processed.png")
 
         if export_unprocessed:
             cv2.imwrite(
                 f"{path}_unprocessed.png",
-                cv2.cvtColor(unprocessed, cv2.COLOR_RGB2BGR)
+                unprocessed_bgr
             )
+            outputs.append(f"{path}_unprocessed.png")
 
     if ExportFormat.QOI in export_formats:
-        qoi.write(f"{path}_processed.qoi", processed)
+        qoi.write(f"{path}_processed.qoi", to_channel_order(processed, processed_order, ChannelOrder.RGB))
+        outputs.append(f"{path}_processed.qoi")
         if export_unprocessed:
-            qoi.write(f"{path}_unprocessed.qoi", unprocessed)
+            qoi.write(f"{path}_unprocessed.qoi", to_channel_order(unprocessed, order, ChannelOrder.RGB))
+            outputs.append(f"{path}_unprocessed.qoi")
+
+    return outputs
+
+
+def encode(image, format, order):
+    # Encodes an image into the bytes of the given
+    # format without writing it to the file system
+    match format:
+        case ExportFormat.JPG:
+            _, data = cv2.imencode(
+                ".jpg",
+                to_channel_order(image, order, ChannelOrder.BGR),
+                [int(cv2.IMWRITE_JPEG_QUALITY), 90]
+            )
+        case ExportFormat.PNG:
+            _, data = cv2.imencode(".png", to_channel_order(image, order, ChannelOrder.BGR))
+        case ExportFormat.QOI:
+            return qoi.encode(to_channel_order(image, order, ChannelOrder.RGB))
+
+    return data.tobytes()
+
+
+class ArtifactWriter:
+    def __init__(self, queue_size=ARTIFACT_QUEUE_SIZE):
+        # Debug artifacts are drawn and written on a background
+        # thread, off the critical path of processing. The queue
+        # is bounded, so that pending artifacts cannot pile up.
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def submit(self, function, *arguments):
+        self.jobs.put((function, arguments))
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+
+            function, arguments = job
+            try:
+                function(*arguments)
+            except Exception as error:
+                if self.error is None:
+                    self.error = error
+
+    def close(self):
+        self.jobs.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
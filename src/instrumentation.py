@@ -0,0 +1,280 @@
+import json
+import os
+import resource
+import sys
+import tracemalloc
+
+from enum import Enum
+from time import perf_counter_ns
+
+METRICS_PATH = "{0}/metrics.{1}"
+MEMORY_KEYS = ("rss_peak", "rss_lifetime_peak", "traced_peak")
+
+
+class MetricsFormat(Enum):
+    JSON = 'JSON'
+    TRACE = 'TRACE'
+    PROMETHEUS = 'PROMETHEUS'
+
+    def __str__(self):
+        return self.value
+
+
+def get_peak_rss():
+    # Linux reports the resident set size
+    # high-water mark in kilobytes, macOS in bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak
+
+    return peak * 1024
+
+
+def reset_peak_rss():
+    # Linux allows for resetting the high-water mark, so
+    # that it only covers what happens afterwards. It
+    # fails on other platforms and older kernels.
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def get_current_peak_rss():
+    # The high-water mark since the last reset
+    # is reported in kilobytes as 'VmHWM'
+    with open("/proc/self/status", "r") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+
+    return get_peak_rss()
+
+
+def to_seconds(nanoseconds):
+    return nanoseconds / 1e9
+
+
+def to_microseconds(nanoseconds):
+    return nanoseconds / 1e3
+
+
+class Instrumentation:
+    def __init__(self, trace_memory=False, verbose=False, stage_rss=False):
+        self.trace_memory = trace_memory
+        self.verbose = verbose
+        self.stage_rss = stage_rss
+        self.step = 1
+        self.origin = perf_counter_ns()
+        self.records = list()
+        self.record = None
+        self.stage = None
+        self.rss_peak = 0
+
+        # Tracing allocations has a noticeable overhead,
+        # which is why it has to be requested explicitly
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def now(self):
+        return perf_counter_ns() - self.origin
+
+    def begin_image(self, name):
+        self.record = {
+            "image": name,
+            "start": self.now(),
+            "end": None,
+            "stages": list(),
+            "counts": dict()
+        }
+        self.records.append(self.record)
+        self.step = 1
+        self.rss_peak = 0
+
+    def end_image(self):
+        self.record["end"] = self.now()
+        return self.elapsed()
+
+    def elapsed(self):
+        end = self.record["end"] if self.record["end"] is not None else self.now()
+        return to_seconds(end - self.record["start"])
+
+    def begin(self, name):
+        # The allocation peak is reset, so that
+        # it only covers the upcoming stage
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+
+        # Resetting the resident set size high-water mark
+        # affects the whole process, which is why it has to
+        # be requested by single-image callers explicitly.
+        # Otherwise, the peak over the process lifetime is
+        # recorded under a name saying so.
+        self.stage = {
+            "name": name,
+            "start": self.now(),
+            "is_reset": self.stage_rss and reset_peak_rss()
+        }
+        if self.verbose:
+            print(f"{self.step}. {name}", end='\r')
+
+    def end(self):
+        stage = self.stage
+        stage["end"] = self.now()
+        if stage.pop("is_reset"):
+            stage["rss_peak"] = get_current_peak_rss()
+        else:
+            stage["rss_lifetime_peak"] = get_peak_rss()
+        self.rss_peak = max(self.rss_peak, stage.get("rss_peak", stage.get("rss_lifetime_peak")))
+        if self.trace_memory:
+            _, stage["traced_peak"] = tracemalloc.get_traced_memory()
+
+        self.record["stages"].append(stage)
+        self.stage = None
+
+        delta = to_seconds(stage["end"] - stage["start"])
+        if self.verbose:
+            print(f"{self.step}. {stage['name']}".ljust(35), f"{delta}s")
+            self.step += 1
+
+        return delta
+
+    def count(self, name, value):
+        self.record["counts"][name] = int(value)
+
+
+# ====================================
+# ||      Metrics Serialization     ||
+# ====================================
+def to_json(records, indent=4):
+    images = list()
+    for record in records:
+        stages = list()
+        for stage in record["stages"]:
+            entry = {
+                "name": stage["name"],
+                "start": to_seconds(stage["start"]),
+                "duration": to_seconds(stage["end"] - stage["start"])
+            }
+            for key in MEMORY_KEYS:
+                if key in stage:
+                    entry[key] = stage[key]
+            stages.append(entry)
+
+        end = record["end"] if record["end"] is not None else record["start"]
+        images.append({
+            "image": record["image"],
+            "duration": to_seconds(end - record["start"]),
+            "stages": stages,
+            "counts": record["counts"]
+        })
+
+    return json.dumps(images, ensure_ascii=False, indent=indent)
+
+
+def to_trace(records):
+    # Chrome trace-event format, which can be loaded
+    # into 'chrome://tracing' or Perfetto directly
+    process = os.getpid()
+    events = list()
+    for thread, record in enumerate(records):
+        events.append({
+            "name": "thread_name",
+            "ph": "M",
+            "pid": process,
+            "tid": thread,
+            "args": {"name": record["image"]}
+        })
+
+        for stage in record["stages"]:
+            arguments = {key: stage[key] for key in MEMORY_KEYS if key in stage}
+
+            events.append({
+                "name": stage["name"],
+                "cat": "stage",
+                "ph": "X",
+                "ts": to_microseconds(stage["start"]),
+                "dur": to_microseconds(stage["end"] - stage["start"]),
+                "pid": process,
+                "tid": thread,
+                "args": arguments
+            })
+
+        if record["counts"]:
+            end = record["end"] if record["end"] is not None else record["start"]
+            events.append({
+                "name": "counts",
+                "ph": "C",
+                "ts": to_microseconds(end),
+                "pid": process,
+                "tid": thread,
+                "args": record["counts"]
+            })
+
+    return json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}, ensure_ascii=False)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def to_prometheus(records):
+    families = {
+        "plygn_image_duration_seconds": ("gauge", "Wall-clock duration of processing an image", list()),
+        "plygn_stage_duration_seconds": ("gauge", "Wall-clock duration of a pipeline stage", list()),
+        "plygn_stage_rss_peak_bytes": ("gauge", "Resident set size high-water mark during a pipeline stage", list()),
+        "plygn_stage_rss_lifetime_peak_bytes": ("gauge", "Resident set size high-water mark of the process after a pipeline stage", list()),
+        "plygn_stage_traced_peak_bytes": ("gauge", "Peak of traced allocations during a pipeline stage", list()),
+        "plygn_image_items": ("gauge", "Amount of items produced while processing an image", list())
+    }
+
+    for record in records:
+        image = escape_label(record["image"])
+        end = record["end"] if record["end"] is not None else record["start"]
+        families["plygn_image_duration_seconds"][2].append(
+            (f'image="{image}"', to_seconds(end - record["start"]))
+        )
+
+        for stage in record["stages"]:
+            labels = f'image="{image}",stage="{escape_label(stage["name"])}"'
+            families["plygn_stage_duration_seconds"][2].append((labels, to_seconds(stage["end"] - stage["start"])))
+            if "rss_peak" in stage:
+                families["plygn_stage_rss_peak_bytes"][2].append((labels, stage["rss_peak"]))
+            if "rss_lifetime_peak" in stage:
+                families["plygn_stage_rss_lifetime_peak_bytes"][2].append((labels, stage["rss_lifetime_peak"]))
+            if "traced_peak" in stage:
+                families["plygn_stage_traced_peak_bytes"][2].append((labels, stage["traced_peak"]))
+
+        for kind, value in record["counts"].items():
+            families["plygn_image_items"][2].append((f'image="{image}",kind="{escape_label(kind)}"', value))
+
+    lines = list()
+    for name, (kind, description, samples) in families.items():
+        if not samples:
+            continue
+
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{name}{{{labels}}} {value}")
+
+    return '\n'.join(lines) + '\n'
+
+
+# Further sinks can be plugged in by registering
+# a serializer and file suffix for a format
+METRICS_SINKS = {
+    MetricsFormat.JSON: (to_json, "json"),
+    MetricsFormat.TRACE: (to_trace, "trace.json"),
+    MetricsFormat.PROMETHEUS: (to_prometheus, "prom")
+}
+
+
+def write_metrics(output, records, formats):
+    for format in formats:
+        serialize, suffix = METRICS_SINKS[format]
+        path = METRICS_PATH.format(output, suffix)
+        with open(path, "w+") as metrics_file:
+            metrics_file.write(serialize(records))
@@ -0,0 +1,66 @@
+import cv2
+import numpy as np
+import os
+import qoi
+import rawpy
+
+from colorspace import ChannelOrder
+from enum import Enum
+
+
+def is_supported_image_format(path):
+    basename = os.path.basename(path)
+    if not "." in basename:
+        return False
+
+    _, format = basename.split('.', 1)
+    return format.upper() in ["NEF", "RAW", "JPG", "JPEG", "PNG", "BMP", "NPY"]
+
+
+class RawDecoding(Enum):
+    FULL = 'FULL'
+    HALF = 'HALF'
+    PREVIEW = 'PREVIEW'
+
+    def __str__(self):
+        return self.value
+
+
+def load_raw_image(path, raw_decoding):
+    with rawpy.imread(path) as raw:
+        if raw_decoding is RawDecoding.PREVIEW:
+            # The embedded preview is much faster to obtain than
+            # demosaicing the sensor data, which makes it a good
+            # fit for quick runs over large batches
+            try:
+                thumbnail = raw.extract_thumb()
+                if thumbnail.format == rawpy.ThumbFormat.JPEG:
+                    image_data = cv2.imdecode(np.frombuffer(thumbnail.data, dtype=np.uint8), cv2.IMREAD_COLOR)
+                    return image_data, ChannelOrder.BGR
+                return thumbnail.data, ChannelOrder.RGB
+            except (rawpy.LibRawNoThumbnailError, rawpy.LibRawUnsupportedThumbnailError):
+                return raw.postprocess(half_size=True), ChannelOrder.RGB
+
+        # Half-size decoding skips demosaicing by merging
+        # each Bayer block into a single pixel
+        return raw.postprocess(half_size=(raw_decoding is RawDecoding.HALF)), ChannelOrder.RGB
+
+
+def load_image(path, raw_decoding=RawDecoding.FULL):
+    image_name, image_format = os.path.basename(path).split('.', 1)
+
+    # Images are kept in the channel order they are decoded
+    # in, which is passed along instead of converting them
+    if image_format.upper() in ["NEF", "RAW"]:
+        image_data, channel_order = load_raw_image(path, raw_decoding)
+    elif image_format.upper() in ["QOI"]:
+        image_data, channel_order = qoi.read(path), ChannelOrder.RGB
+    elif image_format.upper() in ["NPY"]:
+        # Pixel arrays are memory-mapped instead of being
+        # read, so that tiles are paged in on demand. They
+        # are expected to be stored in RGB channel order.
+        image_data, channel_order = np.load(path, mmap_mode='r'), ChannelOrder.RGB
+    else:
+        image_data, channel_order = cv2.imread(path), ChannelOrder.BGR
+
+    return image_name, image_data, channel_order
@@ -0,0 +1,86 @@
+import hashlib
+import json
+import os
+
+MANIFEST_PATH = "{0}/manifest.jsonl"
+MANIFEST_CHUNK = 2 ** 20
+
+
+def hash_file(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(MANIFEST_CHUNK), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+class Manifest:
+    def __init__(self, output):
+        # The manifest is a journal with one entry per line, of
+        # which later ones supersede earlier ones. A line that
+        # cannot be read (e.g. because a previous run crashed
+        # while writing it) is skipped.
+        self.path = MANIFEST_PATH.format(output)
+        self.entries = dict()
+        if os.path.exists(self.path):
+            is_intact = True
+            with open(self.path, "r") as manifest_file:
+                for line in manifest_file:
+                    is_intact = line.endswith("\n")
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.entries[entry.pop("input")] = entry
+
+            # A truncated last line is dropped, so
+            # that new entries start on their own line
+            if not is_intact:
+                self.compact()
+
+    def get_fingerprint(self, path):
+        # Content is only hashed again, if size or modification
+        # time differ from what has been recorded for the input
+        key = os.path.abspath(path)
+        stat = os.stat(path)
+        entry = self.entries.get(key)
+        if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+            digest = entry["hash"]
+        else:
+            digest = hash_file(path)
+
+        return {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": digest}
+
+    def is_up_to_date(self, path, fingerprint, parameters):
+        entry = self.entries.get(os.path.abspath(path))
+        if entry is None:
+            return False
+
+        return entry["hash"] == fingerprint["hash"] \
+            and entry["parameters"] == parameters \
+            and all(os.path.exists(output) for output in entry["outputs"])
+
+    def record(self, path, fingerprint, parameters, outputs):
+        # Entries are appended once all outputs of an image
+        # exist, which lets interrupted runs resume where
+        # they stopped without rewriting the whole manifest
+        key = os.path.abspath(path)
+        self.entries[key] = {
+            **fingerprint,
+            "parameters": parameters,
+            "outputs": outputs
+        }
+        with open(self.path, "a") as manifest_file:
+            manifest_file.write(json.dumps({"input": key, **self.entries[key]}, ensure_ascii=False) + "\n")
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+
+    def compact(self):
+        # Superseded entries are dropped by replacing
+        # the journal atomically with the current state
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w+") as manifest_file:
+            for key, entry in self.entries.items():
+                manifest_file.write(json.dumps({"input": key, **entry}, ensure_ascii=False) + "\n")
+        os.replace(temporary, self.path)
@@ -1,31 +1,34 @@
 #!/usr/bin/env python3
 import argparse
-import cv2
+import copy
+import glob
 import os
-import qoi
-import rawpy
 import sys
 
+from arena import *
 from benchmark import *
 from clustering import *
 from colorization import *
 from colorspace import *
 from contouring import *
+from density import *
 from export import *
+from instrumentation import *
+from loading import *
+from manifest import *
+from prefetch import *
+from pyramid import *
+from sequence import *
+from tiling import *
 from triangulation import *
 from utils import *
+from time import perf_counter
 
+PROGRESSIVE_LEVELS = ((4, 4, 4), (2, 2, 2))
+PROGRESSIVE_GROWTH = 2.0
 
-def parse_arguments():
-    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument("-i", "--input",
-                        required=True,
-                        type=str,
-                        help="Path to input image")
-    parser.add_argument("-o", "--output",
-                        required=True,
-                        type=str,
-                        help="Path to output image")
+
+def add_pipeline_arguments(parser):
     parser.add_argument("-c", "--colorspace",
                         required=False,
                         type=ColorSpace,
@@ -34,24 +37,79 @@ def parse_arguments():
                         help="Color space for clustering image data")
     parser.add_argument("-d", "--distance",
                         required=False,
+                        type=int,
                         default=10,
                         help="Preferred vertex distance")
     parser.add_argument("-s", "--splitting",
                         required=False,
+                        type=int,
                         default=-1,
                         help="Maximum triangle area before splitting into smaller triangles")
     parser.add_argument("-v", "--variance",
                         required=False,
+                        type=float,
                         default=-1.0,
                         help="Maximum allowed color variance for a triangle to be drawn")
     parser.add_argument("-n", "--noise-kernel",
                         required=False,
+                        type=int,
                         default=5,
                         help="Kernel size for noise reduction on contours")
     parser.add_argument("-k", "--kmeans",
                         required=False,
+                        type=int,
                         default=8,
                         help="Centroid count for kmeans color clustering")
+    parser.add_argument("--pyramid",
+                        required=False,
+                        type=int,
+                        default=1,
+                        help="Downscaling factor of the image used for clustering, contouring and vertex search")
+    parser.add_argument("--no-refine",
+                        required=False,
+                        action='store_true',
+                        help="Flag for skipping the refinement of upscaled vertices in pyramid mode")
+    parser.add_argument("--tile-size",
+                        required=False,
+                        type=int,
+                        default=0,
+                        help="Edge length of tiles for processing very large images tile by tile (0 disables tiling)")
+    parser.add_argument("--tile-overlap",
+                        required=False,
+                        type=int,
+                        default=64,
+                        help="Overlap of analysis windows beyond their tiles")
+    parser.add_argument("-w", "--workers",
+                        required=False,
+                        type=int,
+                        default=os.cpu_count(),
+                        help="Worker count for processing tiles in parallel")
+    parser.add_argument("--density",
+                        required=False,
+                        action='store_true',
+                        help="Flag for placing vertices and splitting triangles more densely in salient regions")
+    parser.add_argument("--density-floor",
+                        required=False,
+                        type=float,
+                        default=DENSITY_FLOOR,
+                        help="Relative vertex and triangle density in the least salient regions")
+    parser.add_argument("--triangle-budget",
+                        required=False,
+                        type=int,
+                        default=0,
+                        help="Maximum amount of triangles per image (0 disables the budget)")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-i", "--input",
+                        required=True,
+                        type=str,
+                        help="Path to input image, directory or glob pattern")
+    parser.add_argument("-o", "--output",
+                        required=True,
+                        type=str,
+                        help="Path to output image")
     parser.add_argument("-f", "--formats",
                         required=False,
                         type=ExportFormat,
@@ -67,6 +125,22 @@ def parse_arguments():
                         required=False,
                         action='store_true',
                         help="Flag for plotting image in selected color space")
+    parser.add_argument("--plot-format",
+                        required=False,
+                        type=PlotFormat,
+                        choices=list(PlotFormat),
+                        default=PlotFormat.VIEWER,
+                        help="Whether to open the plot in a viewer or to write it as file")
+    parser.add_argument("--plot-voxels",
+                        required=False,
+                        type=int,
+                        default=PLOT_VOXELS,
+                        help="Voxels per axis for aggregating the plotted colors (0 disables aggregation)")
+    parser.add_argument("--plot-limit",
+                        required=False,
+                        type=int,
+                        default=PLOT_LIMIT,
+                        help="Maximum amount of plotted points (0 disables the limit)")
     parser.add_argument("-C", "--export-contours",
                         required=False,
                         action='store_true',
@@ -79,6 +153,76 @@ def parse_arguments():
                         required=False,
                         action='store_true',
                         help="Flag for exporting unprocessed image in specified formats for comparison")
+    parser.add_argument("-m", "--max-memory",
+                        required=False,
+                        type=parse_size,
+                        default=ARENA_BUDGET,
+                        help="Budget for work buffers kept for reuse across stages and images, e.g. 512M (0 keeps no buffers)")
+    parser.add_argument("-M", "--metrics",
+                        required=False,
+                        type=MetricsFormat,
+                        choices=list(MetricsFormat),
+                        default=[],
+                        nargs='+',
+                        help="Formats for writing per-stage timing and memory metrics")
+    parser.add_argument("--trace-memory",
+                        required=False,
+                        action='store_true',
+                        help="Flag for tracing allocation peaks per stage (slows down processing)")
+    parser.add_argument("-G", "--progressive",
+                        required=False,
+                        action='store_true',
+                        help="Flag for writing coarse previews before refining them into the final result")
+    parser.add_argument("--time-budget",
+                        required=False,
+                        type=float,
+                        default=0,
+                        help="Seconds after which progressive refinement is cut short (0 disables the budget)")
+    parser.add_argument("--density-map",
+                        required=False,
+                        type=str,
+                        default=None,
+                        help="Path to grayscale mask of regions of interest, used instead of the automatic saliency map")
+    parser.add_argument("-R", "--raw",
+                        required=False,
+                        type=RawDecoding,
+                        choices=list(RawDecoding),
+                        default=RawDecoding.FULL,
+                        help="Decoding mode for RAW images (full, half-size or embedded preview)")
+    parser.add_argument("-S", "--sequence",
+                        required=False,
+                        action='store_true',
+                        help="Flag for processing a directory as frame sequence, reusing palette and unchanged tiles")
+    parser.add_argument("--change-threshold",
+                        required=False,
+                        type=int,
+                        default=12,
+                        help="Minimum channel difference for a pixel to count as changed in sequence mode")
+    parser.add_argument("--prefetch",
+                        required=False,
+                        type=int,
+                        default=2,
+                        help="Amount of images decoded ahead in the background in directory mode")
+    parser.add_argument("-K", "--palette",
+                        required=False,
+                        type=PaletteMode,
+                        choices=list(PaletteMode),
+                        default=PaletteMode.INDEPENDENT,
+                        help="Whether images of a directory share a palette, are warm-started from it or are clustered independently")
+    parser.add_argument("--palette-samples",
+                        required=False,
+                        type=int,
+                        default=PALETTE_SAMPLES,
+                        help="Amount of images sampled for fitting the palette shared by a directory")
+    parser.add_argument("-r", "--recursive",
+                        required=False,
+                        action='store_true',
+                        help="Flag for including images in subdirectories in directory mode")
+    parser.add_argument("-I", "--incremental",
+                        required=False,
+                        action='store_true',
+                        help="Flag for skipping images whose content, parameters and outputs are unchanged since the last run")
+    add_pipeline_arguments(parser)
     return parser.parse_args()
 
 
@@ -87,189 +231,585 @@ def write_parameter_hint(path):
         file.write(' '.join(sys.argv))
 
 
-def is_supported_image_format(path):
-    basename = os.path.basename(path)
-    if not "." in basename:
-        return False
+def get_effective_parameters(options):
+    # Only options that affect the exported images or debug
+    # artifacts are compared, so that e.g. changing the metrics
+    # formats does not cause images to be processed again
+    parameters = {
+        "colorspace": str(options.colorspace),
+        "distance": options.distance,
+        "splitting": options.splitting,
+        "variance": options.variance,
+        "noise_kernel": options.noise_kernel,
+        "kmeans": options.kmeans,
+        "pyramid": options.pyramid,
+        "refine": not options.no_refine,
+        "tile_size": options.tile_size,
+        "tile_overlap": options.tile_overlap,
+        "formats": sorted(str(format) for format in export_formats),
+        "export_unprocessed": options.export_unprocessed,
+        "export_contours": options.export_contours,
+        "export_triangulation": options.export_triangulation,
+        "plot": options.plot,
+        "plot_format": str(options.plot_format),
+        "plot_voxels": options.plot_voxels,
+        "plot_limit": options.plot_limit,
+        "raw": str(options.raw),
+        "sequence": options.sequence,
+        "change_threshold": options.change_threshold,
+        "progressive": options.progressive,
+        "time_budget": options.time_budget,
+        "palette": str(options.palette),
+        "palette_samples": options.palette_samples,
+        "density": options.density,
+        "density_map": options.density_map,
+        "density_map_hash": hash_file(options.density_map) if options.density_map is not None else None,
+        "density_floor": options.density_floor,
+        "triangle_budget": options.triangle_budget
+    }
+    return parameters
+
+
+def find_targets(input_path, recursive):
+    # Returns the root that output folders are mirrored
+    # from together with all files below it, which are
+    # matched by a glob pattern or listed from a directory
+    if glob.escape(input_path) != input_path:
+        targets = [path for path in glob.glob(input_path, recursive=True) if os.path.isfile(path)]
+        if not targets:
+            return None, targets
+        return os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in targets]), targets
+
+    if not recursive:
+        return input_path, [os.path.join(input_path, entry) for entry in os.listdir(input_path)]
+
+    targets = list()
+    for folder, _, files in os.walk(input_path):
+        targets += [os.path.join(folder, file) for file in files]
+    return input_path, targets
 
-    _, format = basename.split('.', 1)
-    return format.upper() in ["NEF", "RAW", "JPG", "JPEG", "PNG", "BMP"]
 
+def add_benchmark(benchmark):
+    benchmark_results.append(benchmark)
+    write_benchmarks(output_path, benchmark_results)
 
-def load_image(path):
-    image_name, image_format = os.path.basename(path).split('.', 1)
 
-    if image_format.upper() in ["NEF", "RAW"]:
-        image_data = rawpy.imread(path).postprocess()
-    elif image_format.upper() in ["QOI"]:
-        image_data = qoi.read(path)
-    else:
-        image_data = cv2.imread(path)
+def add_metrics():
+    # Metrics of all images are serialized once at the end,
+    # as rewriting them after every image would take time
+    # quadratic in the amount of images
+    if metrics_formats:
+        write_metrics(output_path, metrics.records, metrics_formats)
 
-    image_data = cv2.cvtColor(image_data, cv2.COLOR_BGR2RGB)
-    return image_name, image_data
 
+def export_artifact(writer, function, *arguments):
+    # Without a background writer, artifacts
+    # are exported on the calling thread
+    if writer is None:
+        function(*arguments)
+    else:
+        writer.submit(function, *arguments)
 
-def logging_pre(description):
-    global logging_desc
-    global logging_time
-    logging_desc = description
-    logging_time = time()
-    print(f"{logging_step}. {description}", end='\r')
 
+def find_batch_palette(targets, options):
+    # The codebook is fitted on the combined color histogram
+    # of images sampled evenly across the whole batch
+    step = max(1, -(-len(targets) // max(1, options.palette_samples)))
+    histogram = np.zeros((256 ** 3), dtype=np.int64)
+    for file in targets[::step]:
+        _, image_data, channel_order = load_image(file, options.raw)
+        if options.pyramid > 1:
+            image_data = downscale(image_data, options.pyramid)
+        tile_size = options.tile_size if options.tile_size > 0 else max(image_data.shape[:2])
+        accumulate_histogram(histogram, image_data, channel_order, find_tiles(image_data.shape, tile_size))
+        del image_data
 
-def logging_post():
-    global logging_step
-    delta = (time() - logging_time).total_seconds()
-    print(f"{logging_step}. {logging_desc}".ljust(35), f"{delta}s")
-    logging_step += 1
+    unique_ints, unique_colors, unique_counts = to_histogram_colors(histogram)
+    translated_unique_colors = to_space(unique_colors, options.colorspace, unique_ints)
+    return fit_palette(options.kmeans, translated_unique_colors, unique_counts)
 
 
-def add_benchmark(benchmark):
-    benchmark_results.append(benchmark)
-    write_benchmarks(output_path, benchmark_results)
+def get_buffer(arena, name, shape, dtype):
+    # Without an arena, buffers are
+    # allocated for a single use
+    if arena is None:
+        return np.empty(shape, dtype=dtype)
 
+    return arena.get(name, shape, dtype)
 
-def process_image(in_path, out_path):
-    # =============================
-    # ||      Image Loading      ||
-    # =============================
-    image_name, image_data = load_image(in_path)
-    print(f"Processing '{truncate_path(in_path, 3)}'")
-    start = time()
+
+def polygonize(image_data, channel_order, image_name, out_path, options, metrics, writer=None, codebook=None,
+               arena=None):
+    # ==================================
+    # ||      Pyramid Operations      ||
+    # ==================================
+    # In pyramid mode, all stages up to the vertex search
+    # analyse a downscaled image, whereas triangulation and
+    # colorization still happen at full resolution
+    analysis_data = image_data
+    analysis_distance = options.distance
+    analysis_kernel = options.noise_kernel
+    if options.pyramid > 1:
+        # Contours are drawn onto the downscaled image in the
+        # background, which is why it must not be reused then
+        metrics.begin("Downscaling")
+        analysis_shape = find_downscaled_shape(image_data.shape, options.pyramid)
+        analysis_buffer = get_buffer(arena if not options.export_contours else None, "analysis", analysis_shape,
+                                     image_data.dtype)
+        analysis_data = downscale(image_data, options.pyramid, analysis_buffer)
+        analysis_distance = max(1, options.distance // options.pyramid)
+        if options.noise_kernel > 0:
+            analysis_kernel = max(1, options.noise_kernel // options.pyramid)
+        metrics.end()
 
     # ======================================
     # ||      Color Space Operations      ||
     # ======================================
-    logging_pre("Color Space Transformation")
-    image_as_ints, unique_ints, unique_colors, unique_counts = dedupe_colors(image_data)
-    translated_unique_colors = to_space(unique_colors, colorspace)
-    logging_post()
-
-    if flag_plot is True:
-        logging_pre("Plotting")
-        plot(unique_colors, translated_unique_colors)
-        logging_post()
-
-    logging_pre("Color Clustering")
-    labels = kmeans(kmeans_centroids, translated_unique_colors, unique_counts)
-    labels = expand_labels(image_as_ints, unique_ints, labels, image_data.shape)
-    logging_post()
+    metrics.begin("Color Space Transformation")
+    analysis_ints = get_buffer(arena, "ints", analysis_data.shape[:2], np.int32)
+    image_as_ints, unique_ints, unique_colors, unique_counts = dedupe_colors(analysis_data, channel_order, analysis_ints)
+    translated_unique_colors = to_space(unique_colors, options.colorspace, unique_ints)
+    metrics.count("pixels", image_data.shape[0] * image_data.shape[1])
+    metrics.count("unique_colors", len(unique_ints))
+    metrics.end()
+
+    metrics.begin("Color Clustering")
+    if codebook is None:
+        centroids = fit_palette(options.kmeans, translated_unique_colors, unique_counts)
+    else:
+        centroids = find_palette(options.palette, options.kmeans, translated_unique_colors, unique_counts, codebook)
+    labels = assign_labels(centroids, translated_unique_colors)
+    label_dtype = get_label_dtype(options.kmeans)
+    lookup = get_buffer(arena, "lookup", (256 ** 3), label_dtype)
+    label_map = get_buffer(arena, "labels", analysis_data.shape[:2], label_dtype)
+    labels = expand_labels(image_as_ints, unique_ints, labels, analysis_data.shape, lookup, label_map)
+    metrics.end()
+
+    if options.plot is True:
+        metrics.begin("Plotting")
+        partial_folder = make_folder(out_path, image_name)
+        export_folder = make_folder(partial_folder, options.colorspace)
+        plot(unique_colors, translated_unique_colors, unique_counts, centroids,
+             options.plot_voxels, options.plot_limit, options.plot_format, export_folder)
+        metrics.end()
 
     # ==================================
     # ||      Contour Operations      ||
     # ==================================
-    logging_pre("Contouring")
-    contours = find_contours(image_data, kmeans_centroids, labels, noise_kernel)
-    logging_post()
-
-    if flag_contours is True:
-        logging_pre("Exporting Contours")
+    metrics.begin("Contouring")
+    bitmask = get_buffer(arena, "bitmask", analysis_data.shape[:2], np.uint8)
+    contours = find_contours(options.kmeans, labels, analysis_kernel, bitmask)
+    metrics.count("contours", sum(len(contour_group) for contour_group in contours))
+    metrics.end()
+
+    if options.export_contours is True:
+        metrics.begin("Exporting Contours")
         partial_folder = make_folder(out_path, image_name)
-        export_folder = make_folder(partial_folder, colorspace)
-        export_contours(image_data, contours, export_folder)
-        logging_post()
+        export_folder = make_folder(partial_folder, options.colorspace)
+        export_artifact(writer, export_contours, analysis_data, channel_order, contours, export_folder)
+        metrics.end()
 
-    logging_pre("Vertex Search")
-    vertices = find_vertices(contours, distance)
-    logging_post()
+    # ==================================
+    # ||      Density Estimation      ||
+    # ==================================
+    # Salient regions (or those marked in a given mask) are
+    # covered by more vertices and triangles than the rest
+    density = None
+    if options.density or options.density_map is not None:
+        metrics.begin("Density Estimation")
+        density = find_density(analysis_data, channel_order, options.density_floor, options.density_map)
+        metrics.end()
+
+    metrics.begin("Vertex Search")
+    vertices = find_budgeted_vertices(contours, analysis_distance, density, options.triangle_budget)
+    metrics.count("vertices", len(vertices))
+    metrics.end()
+
+    if options.pyramid > 1:
+        metrics.begin("Vertex Upscaling")
+        vertices = to_full_resolution(image_data, channel_order, vertices, options.pyramid, not options.no_refine)
+        metrics.end()
 
     # ===================================
     # ||      Triangle Operations      ||
     # ===================================
-    logging_pre("Triangulation")
+    metrics.begin("Triangulation")
     triangulation = find_triangulation(image_data.shape, vertices)
-    logging_post()
-
-    if splitting > 0:
-        logging_pre("Triangle Splitting")
-        triangulation = split_triangulation(triangulation, splitting)
-        logging_post()
-
-    if flag_triangulation is True:
-        logging_pre("Exporting Triangulation")
+    metrics.end()
+
+    if options.splitting > 0:
+        metrics.begin("Triangle Splitting")
+        thresholds = options.splitting
+        if density is not None:
+            thresholds = find_split_thresholds(triangulation, density, options.splitting, options.pyramid)
+        if options.triangle_budget > 0:
+            thresholds = fit_split_budget(triangulation, thresholds, options.triangle_budget)
+        triangulation = split_triangulation(triangulation, thresholds)
+        metrics.end()
+
+    if options.export_triangulation is True:
+        metrics.begin("Exporting Triangulation")
         partial_folder = make_folder(out_path, image_name)
-        export_folder = make_folder(partial_folder, colorspace)
-        export_triangulation(image_data, triangulation, export_folder)
-        logging_post()
+        export_folder = make_folder(partial_folder, options.colorspace)
+        export_artifact(writer, export_triangulation, image_data, channel_order, triangulation, export_folder)
+        metrics.end()
 
     # ============================
     # ||      Colorization      ||
     # ============================
-    logging_pre("Triangle Colorization")
-    colorized_image = colorize(image_data, triangulation, variance)
-    logging_post()
+    metrics.begin("Triangle Colorization")
+    metrics.count("triangles", len(triangulation))
+    canvas = get_buffer(arena, "canvas", image_data.shape, image_data.dtype)
+    colorized_image = colorize(image_data, triangulation, options.variance, canvas)
+    metrics.end()
+    return colorized_image
+
+
+def polygonize_full_resolution(image_data, channel_order, image_name, out_path, options):
+    # The reference run is neither instrumented
+    # nor does it export any debug artifacts
+    reference = copy.copy(options)
+    reference.pyramid = 1
+    reference.plot = False
+    reference.export_contours = False
+    reference.export_triangulation = False
+    start = perf_counter()
+    colorized_image = polygonize(image_data, channel_order, image_name, out_path, reference, Instrumentation(), None,
+                                 batch_palette)
+    return perf_counter() - start, colorized_image
+
+
+def count_palette(metrics, image_data, unique_color_count, tiles):
+    # Colors are not counted, if a shared
+    # palette has been used as it is
+    metrics.count("pixels", image_data.shape[0] * image_data.shape[1])
+    if unique_color_count is not None:
+        metrics.count("unique_colors", unique_color_count)
+    metrics.count("tiles", len(tiles))
+
+
+def polygonize_tiled(image_data, channel_order, image_name, out_path, options, metrics, codebook=None):
+    # =====================================
+    # ||      Global Palette Fitting     ||
+    # =====================================
+    tiles = find_tiles(image_data.shape, options.tile_size)
+    metrics.begin("Palette Fitting")
+    if codebook is None:
+        centroids, unique_color_count = find_global_palette(image_data, channel_order, tiles, options.kmeans,
+                                                            options.colorspace)
+    else:
+        centroids, unique_color_count = find_global_palette(image_data, channel_order, tiles, options.kmeans,
+                                                            options.colorspace, codebook, options.palette)
+    count_palette(metrics, image_data, unique_color_count, tiles)
+    metrics.end()
+
+    # ===============================
+    # ||      Tile Processing      ||
+    # ===============================
+    metrics.begin("Tile Processing")
+    # The canvas is held in the order of the encoders, so
+    # that it is exported without converting it as a whole
+    canvas = make_canvas(os.path.normpath(f"{out_path}/{image_name}"), image_data.shape)
+    canvas_order = ChannelOrder.BGR if {ExportFormat.JPG, ExportFormat.PNG} & export_formats else ChannelOrder.RGB
+    counts = process_tiles(image_data, channel_order, canvas, canvas_order, tiles, options.workers, options.tile_overlap,
+                           centroids, options.colorspace, options.noise_kernel, options.distance, options.splitting,
+                           options.variance)
+    for name, value in counts.items():
+        metrics.count(name, value)
+    metrics.end()
+    return canvas, canvas_order
+
+
+def polygonize_sequence(image_data, channel_order, image_name, out_path, options, metrics, state, codebook=None):
+    # A new sequence starts with the first frame
+    # or whenever the frame dimensions change
+    tiles = find_tiles(image_data.shape, options.tile_size if options.tile_size > 0 else SEQUENCE_TILE_SIZE)
+    is_continued = state.is_compatible(image_data)
+    if not is_continued:
+        state.reset(image_data)
+
+    # =====================================
+    # ||      Warm-Started Palette       ||
+    # =====================================
+    # The first frame starts from the batch palette,
+    # if there is one, and later frames from their
+    # predecessor's palette
+    metrics.begin("Palette Fitting")
+    if codebook is None or options.palette is PaletteMode.INDEPENDENT:
+        state.centroids, unique_color_count = find_global_palette(image_data, channel_order, tiles, options.kmeans,
+                                                                  options.colorspace, state.centroids)
+    else:
+        init = codebook if state.centroids is None else state.centroids
+        state.centroids, unique_color_count = find_global_palette(image_data, channel_order, tiles, options.kmeans,
+                                                                  options.colorspace, init, options.palette)
+    count_palette(metrics, image_data, unique_color_count, tiles)
+    metrics.end()
+
+    # ==================================
+    # ||      Change Detection        ||
+    # ==================================
+    # Only tiles that differ from the content they were last
+    # processed with are processed again, all other tiles
+    # keep their result from previous frames
+    metrics.begin("Change Detection")
+    changed_tiles = tiles
+    if is_continued:
+        changed_tiles = find_changed_tiles(state.reference, image_data, tiles, options.change_threshold)
+    metrics.count("changed_tiles", len(changed_tiles))
+    metrics.end()
+
+    # ===============================
+    # ||      Tile Processing      ||
+    # ===============================
+    metrics.begin("Tile Processing")
+    counts = process_tiles(image_data, channel_order, state.canvas, channel_order, changed_tiles, options.workers,
+                           options.tile_overlap, state.centroids, options.colorspace, options.noise_kernel, options.distance,
+                           options.splitting, options.variance)
+    state.update(image_data, changed_tiles)
+    for name, value in counts.items():
+        metrics.count(name, value)
+    metrics.end()
+    return state.canvas
+
+
+def find_progressive_levels(options):
+    # Coarse levels cluster fewer colors and place fewer
+    # vertices on a downscaled image, whereas the last
+    # level uses the requested options as they are
+    levels = list()
+    for divisor, multiplier, scale in PROGRESSIVE_LEVELS:
+        level = copy.copy(options)
+        level.kmeans = max(2, options.kmeans // divisor)
+        level.distance = options.distance * multiplier
+        level.pyramid = max(options.pyramid, scale)
+        level.splitting = -1
+        level.plot = False
+        level.export_contours = False
+        level.export_triangulation = False
+        levels.append(level)
+
+    levels.append(options)
+    return levels
+
+
+def polygonize_progressively(image_data, channel_order, image_name, out_path, options, metrics, budget=0, writer=None,
+                             codebook=None, arena=None):
+    # Each level yields a complete result, so that callers
+    # can show a coarse preview quickly and replace it with
+    # more refined results as they become available
+    start = perf_counter()
+    levels = find_progressive_levels(options)
+    previous = 0
+    for i, level in enumerate(levels):
+        # Refinement is cut short once the next level is not
+        # expected to finish within the time budget anymore
+        if i > 0 and budget > 0:
+            elapsed = perf_counter() - start
+            if elapsed + previous * PROGRESSIVE_GROWTH > budget:
+                return
+
+        level_start = perf_counter()
+        # Coarse results are exported in the background,
+        # which is why they do not reuse buffers
+        is_final = i == len(levels) - 1
+        colorized_image = polygonize(image_data, channel_order, image_name, out_path, level, metrics, writer, codebook,
+                                     arena if is_final else None)
+        previous = perf_counter() - level_start
+        yield i, is_final, colorized_image
+
+
+def process_image(in_path, out_path, loaded=None):
+    # =============================
+    # ||      Image Loading      ||
+    # =============================
+    # Images may have been loaded ahead of time
+    # by the prefetcher in directory mode
+    if loaded is None:
+        loaded = load_image(in_path, options.raw)
+
+    image_name, image_data, channel_order = loaded
+    print(f"Processing '{truncate_path(in_path, 3)}'")
+    metrics.begin_image(in_path)
+    arena.overflow = 0
+    colorized_order = channel_order
+
+    if options.sequence:
+        colorized_image = polygonize_sequence(image_data, channel_order, image_name, out_path, options, metrics, sequence_state,
+                                              batch_palette)
+    elif options.tile_size > 0:
+        colorized_image, colorized_order = polygonize_tiled(image_data, channel_order, image_name, out_path, options, metrics,
+                                                            batch_palette)
+    elif options.progressive:
+        # Intermediate results are written in the
+        # background as soon as they are available
+        passes = polygonize_progressively(image_data, channel_order, image_name, out_path, options, metrics,
+                                          options.time_budget, artifact_writer, batch_palette, arena)
+        for level, is_final, colorized_image in passes:
+            if not is_final:
+                pass_basename = os.path.normpath(f"{out_path}/{image_name}_pass{level}")
+                artifact_writer.submit(export, pass_basename, colorized_image, image_data, export_formats, False,
+                                       channel_order)
+    else:
+        colorized_image = polygonize(image_data, channel_order, image_name, out_path, options, metrics, artifact_writer,
+                                     batch_palette, arena)
 
-    processing_time = (time() - start).total_seconds()
+    processing_time = metrics.elapsed()
     print(45 * "-")
     print("Processing Time: ".ljust(35), f"{processing_time}s")
 
+    # Buffers kept for reuse and those that had to
+    # be allocated beyond the budget are reported
+    metrics.count("arena_bytes", arena.size)
+    metrics.count("arena_overflow_bytes", arena.overflow)
+    print("Peak Memory: ".ljust(35), f"{metrics.rss_peak / 2 ** 20:.1f} MiB (buffers: {arena.size / 2 ** 20:.1f} MiB)")
+
     # ======================
     # ||      Export      ||
     # ======================
     output_basename = os.path.normpath(f"{out_path}/{image_name}")
-    export(output_basename, colorized_image, image_data, export_formats, flag_unprocessed)
-    total_time = (time() - start).total_seconds()
+    outputs = export(output_basename, colorized_image, image_data, export_formats, options.export_unprocessed, channel_order,
+                     colorized_order)
+    if options.tile_size > 0 and not options.sequence:
+        del colorized_image
+        os.remove(CANVAS_PATH.format(output_basename))
+
+    total_time = metrics.end_image()
     print("Total Time: ".ljust(35), f"{total_time}s")
 
     # ==========================
     # ||      Benchmarking    ||
     # ==========================
-    if flag_benchmark:
-        measurement_type = MeasurementType.SIMPLE if not flag_unprocessed else MeasurementType.COMPARATIVE
-        benchmark = get_benchmark_entry(in_path, output_basename, export_formats, measurement_type, processing_time, total_time)
+    if options.benchmark:
+        measurement_type = MeasurementType.SIMPLE if not options.export_unprocessed else MeasurementType.COMPARATIVE
+        benchmark = get_benchmark_entry(in_path, output_basename, export_formats, measurement_type, processing_time, total_time,
+                                        options.pyramid, options.raw)
+
+        # The quality cost of pyramid mode is measured against
+        # processing the same image with a full-resolution analysis
+        if options.pyramid > 1 and options.tile_size == 0 and not options.sequence:
+            full_resolution_time, full_resolution_image = polygonize_full_resolution(image_data, channel_order, image_name,
+                                                                                     out_path, options)
+            benchmark["reference"]["pyramid_cost"] = get_pyramid_cost(image_data, channel_order, colorized_image,
+                                                                      full_resolution_image, processing_time,
+                                                                      full_resolution_time)
         add_benchmark(benchmark)
 
+    return outputs
 
-def process_images(targets, out_path):
-    processed_images = 0
-    for file in targets:
-        if not is_supported_image_format(file):
-            continue
 
+def process_images(targets, root, out_path):
+    processed_images = 0
+    targets = [file for file in targets if is_supported_image_format(file)]
+    if options.sequence:
+        targets.sort()
+    batch = sorted(targets)
+
+    # =====================================
+    # ||      Incremental Processing     ||
+    # =====================================
+    # Images are skipped if their content, the parameters and
+    # their outputs are unchanged. As the manifest is updated
+    # after every image, an interrupted run resumes where
+    # it stopped when started again.
+    fingerprints = dict()
+    if manifest is not None:
+        parameters = get_effective_parameters(options)
+        pending = list()
+        for file in targets:
+            fingerprints[file] = manifest.get_fingerprint(file)
+            if not manifest.is_up_to_date(file, fingerprints[file], parameters):
+                pending.append(file)
+
+        if len(pending) < len(targets):
+            print(f"[ {len(targets) - len(pending)} images are up to date and have been skipped! ]\n")
+        targets = pending
+
+    # ================================
+    # ||      Batch Palette         ||
+    # ================================
+    # The shared palette is fitted across all images of the
+    # batch, including skipped ones, so that it does not
+    # depend on which images happen to be processed
+    global batch_palette
+    if options.palette is not PaletteMode.INDEPENDENT and targets and len(batch) > 1:
+        print("Fitting batch palette...", end='\r')
+        start = perf_counter()
+        batch_palette = find_batch_palette(batch, options)
+        print("Fitting batch palette:".ljust(35), f"{perf_counter() - start}s\n")
+
+    # Tiled processing bounds memory by the tile size, which
+    # decoding whole images ahead of time would undermine
+    depth = options.prefetch if options.tile_size <= 0 else 0
+    for file, loaded in prefetch(lambda path: load_image(path, options.raw), targets, depth):
         if processed_images > 0:
             print("\n{}\n".format("=" * 60))
 
-        process_image(file, out_path)
-        processed_images += 1
+        # Subdirectories of the input are mirrored,
+        # so that equally named images do not collide
+        relative_folder = os.path.relpath(os.path.dirname(os.path.abspath(file)), os.path.abspath(root))
+        image_out_path = os.path.normpath(os.path.join(out_path, relative_folder))
+        os.makedirs(image_out_path, exist_ok=True)
 
-        global logging_step
-        logging_step = 1
+        outputs = process_image(file, image_out_path, loaded)
+        del loaded
+        if manifest is not None:
+            manifest.record(file, fingerprints[file], parameters, outputs)
+        processed_images += 1
 
     return processed_images
 
 
 if __name__ == '__main__':
-    args = parse_arguments()
-    input_path = os.path.expanduser(args.input)
-    output_path = os.path.expanduser(args.output)
-    colorspace = args.colorspace
-    distance = int(args.distance)
-    splitting = int(args.splitting)
-    variance = float(args.variance)
-    noise_kernel = int(args.noise_kernel)
-    kmeans_centroids = int(args.kmeans)
-    export_formats = set(args.formats)
-    flag_benchmark = args.benchmark
-    flag_plot = args.plot
-    flag_contours = args.export_contours
-    flag_triangulation = args.export_triangulation
-    flag_unprocessed = args.export_unprocessed
+    options = parse_arguments()
+    options.pyramid = max(1, options.pyramid)
+    options.workers = max(1, options.workers)
+    options.density_floor = min(1.0, max(0.01, options.density_floor))
+    if (options.density or options.density_map is not None or options.triangle_budget > 0) \
+            and (options.tile_size > 0 or options.sequence):
+        sys.exit("Options '--density', '--density-map' and '--triangle-budget' are not available with '--tile-size' or '-S'!")
+
+    input_path = os.path.expanduser(options.input)
+    output_path = os.path.expanduser(options.output)
+    export_formats = set(options.formats)
+    metrics_formats = set(options.metrics)
+    metrics = Instrumentation(options.trace_memory, verbose=True, stage_rss=True)
+    sequence_state = SequenceState()
+    artifact_writer = ArtifactWriter()
+    arena = BufferArena(options.max_memory)
+    manifest = Manifest(output_path) if options.incremental else None
+    batch_palette = None
     benchmark_results = list()
-    logging_step = 1
 
-    if not os.path.exists(input_path):
+    is_pattern = glob.escape(input_path) != input_path
+    if not is_pattern and not os.path.exists(input_path):
         sys.exit(f"Target '{input_path}' has not been found!")
 
     write_parameter_hint(output_path)
-    if os.path.isfile(input_path):
+    if not is_pattern and os.path.isfile(input_path):
         if not is_supported_image_format(input_path):
             sys.exit(f"File '{truncate_path(input_path, 3)}' does not have a supported format!")
-            
-        process_image(input_path, output_path)
 
-    elif os.path.isdir(input_path):
-        targets = [os.path.join(input_path, entry) for entry in os.listdir(input_path)]
-        processed_images = process_images(targets, output_path)
+        if manifest is not None:
+            process_images([input_path], os.path.dirname(input_path), output_path)
+        else:
+            process_image(input_path, output_path)
+
+    else:
+        root, targets = find_targets(input_path, options.recursive)
+        if root is None:
+            sys.exit(f"Pattern '{input_path}' does not match any files!")
+
+        processed_images = process_images(targets, root, output_path)
         print(f"[ {processed_images} images have been processed! ]")
+
+    # Superseded manifest entries
+    # are dropped after the run
+    if manifest is not None:
+        manifest.compact()
+
+    add_metrics()
+
+    # Pending debug artifacts
+    # are written before exiting
+    artifact_writer.close()
             
\ No newline at end of file
@@ -0,0 +1,34 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def prefetch(load, targets, depth):
+    # Without any prefetching depth,
+    # targets are loaded synchronously
+    if depth <= 0:
+        for target in targets:
+            yield target, load(target)
+        return
+
+    # Up to 'depth' upcoming targets are decoded on background
+    # threads while the current one is being processed. Results
+    # are handed out in order, so that the queue stays bounded.
+    remaining = iter(targets)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=depth) as executor:
+        for _ in range(depth):
+            target = next(remaining, None)
+            if target is None:
+                break
+            pending.append((target, executor.submit(load, target)))
+
+        while pending:
+            upcoming = next(remaining, None)
+            if upcoming is not None:
+                pending.append((upcoming, executor.submit(load, upcoming)))
+
+            # The future is taken from the queue within the yield
+            # itself, so that no local variable keeps the image
+            # alive while the caller processes it
+            target = pending[0][0]
+            yield target, pending.popleft()[1].result()
@@ -0,0 +1,66 @@
+import cv2
+import numpy as np
+
+from colorspace import ChannelOrder
+from numba import njit
+
+
+def find_downscaled_shape(shape, scale):
+    height, width = shape[:2]
+    return (max(1, height // scale), max(1, width // scale)) + tuple(shape[2:])
+
+
+def downscale(image, scale, out=None):
+    # Area interpolation averages pixel blocks, which
+    # keeps colors representative of the original
+    height, width = find_downscaled_shape(image.shape, scale)[:2]
+    return cv2.resize(image, (width, height), dst=out, interpolation=cv2.INTER_AREA)
+
+
+def upscale_vertices(vertices, scale, shape):
+    # Vertices are moved to the center of the pixel block
+    # they represent and kept within the image bounds
+    height, width = shape[:2]
+    offset = scale // 2
+    upscaled = np.array(vertices, dtype=np.int32).reshape((-1, 2)) * scale + offset
+    upscaled[:, 0] = np.minimum(upscaled[:, 0], width - 1)
+    upscaled[:, 1] = np.minimum(upscaled[:, 1], height - 1)
+    return upscaled
+
+
+def find_gradient_magnitude(image, order):
+    # The L1 norm of the Sobel derivatives is
+    # sufficient for locating the strongest edge
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY if order is ChannelOrder.BGR else cv2.COLOR_RGB2GRAY)
+    dx = cv2.Sobel(gray, cv2.CV_16S, 1, 0)
+    dy = cv2.Sobel(gray, cv2.CV_16S, 0, 1)
+    return np.abs(dx.astype(np.int32)) + np.abs(dy.astype(np.int32))
+
+
+@njit(cache=True, nogil=True)
+def refine_vertices(magnitude, vertices, radius):
+    # Upscaled vertices are only accurate up to the scale
+    # factor, which is why each vertex is snapped to the
+    # strongest edge in its neighbourhood at full resolution
+    height, width = magnitude.shape
+    refined = vertices.copy()
+    for i in range(len(vertices)):
+        x, y = vertices[i]
+        best = magnitude[y, x]
+        for ny in range(max(0, y - radius), min(height, y + radius + 1)):
+            for nx in range(max(0, x - radius), min(width, x + radius + 1)):
+                if magnitude[ny, nx] > best:
+                    best = magnitude[ny, nx]
+                    refined[i, 0] = nx
+                    refined[i, 1] = ny
+
+    return refined
+
+
+def to_full_resolution(image, order, vertices, scale, refine):
+    upscaled = upscale_vertices(vertices, scale, image.shape)
+    if refine and len(upscaled) > 0:
+        magnitude = find_gradient_magnitude(image, order)
+        upscaled = refine_vertices(magnitude, upscaled, scale // 2)
+
+    return [(int(x), int(y)) for x, y in upscaled]
@@ -0,0 +1,44 @@
+import cv2
+import numpy as np
+
+SEQUENCE_TILE_SIZE = 128
+SEQUENCE_CHANGE_RATIO = 0.002
+
+
+class SequenceState:
+    def __init__(self):
+        # The reference holds, for each tile, the frame content
+        # it was last processed with. The canvas holds the most
+        # recent result, from which unchanged tiles are reused.
+        self.reference = None
+        self.canvas = None
+        self.centroids = None
+
+    def is_compatible(self, frame):
+        return self.reference is not None and self.reference.shape == frame.shape
+
+    def reset(self, frame):
+        self.reference = np.array(frame)
+        self.canvas = np.empty_like(self.reference)
+        self.centroids = None
+
+    def update(self, frame, tiles):
+        for y0, y1, x0, x1 in tiles:
+            self.reference[y0:y1, x0:x1] = frame[y0:y1, x0:x1]
+
+
+def find_changed_tiles(reference, frame, tiles, threshold):
+    # A pixel has changed, if any of its channels differs by
+    # more than the threshold. Comparing against the reference
+    # instead of the previous frame ensures, that slow changes
+    # accumulate until a tile is eventually processed again.
+    difference = cv2.absdiff(reference, np.ascontiguousarray(frame)).max(axis=2)
+    changed = difference > threshold
+
+    changed_tiles = list()
+    for tile in tiles:
+        y0, y1, x0, x1 = tile
+        if changed[y0:y1, x0:x1].mean() > SEQUENCE_CHANGE_RATIO:
+            changed_tiles.append(tile)
+
+    return changed_tiles
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+import argparse
+import cv2
+import numpy as np
+import os
+import qoi
+import queue
+import socketserver
+import sys
+import threading
+
+from arena import *
+from colorspace import ChannelOrder
+from export import *
+from instrumentation import *
+from plygn import add_pipeline_arguments, polygonize
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter_ns
+from urllib.parse import urlparse, parse_qsl
+
+SERVICE_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SERVICE_WARMUP_SHAPE = (64, 96, 3)
+SERVICE_CONTENT_TYPES = {
+    ExportFormat.JPG: "image/jpeg",
+    ExportFormat.PNG: "image/png",
+    ExportFormat.QOI: "image/qoi"
+}
+
+
+def to_queue_size(value):
+    # An unbounded queue would silently
+    # disable backpressure altogether
+    size = int(value)
+    if size < 1:
+        raise argparse.ArgumentTypeError("queue size must be at least 1")
+
+    return size
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-p", "--port",
+                        required=False,
+                        type=int,
+                        default=8080,
+                        help="Port on localhost to serve requests on")
+    parser.add_argument("-u", "--socket",
+                        required=False,
+                        type=str,
+                        default=None,
+                        help="Path to Unix socket to serve requests on instead of a port")
+    parser.add_argument("-w", "--workers",
+                        required=False,
+                        type=int,
+                        default=os.cpu_count(),
+                        help="Amount of requests processed in parallel")
+    parser.add_argument("-q", "--queue-size",
+                        required=False,
+                        type=to_queue_size,
+                        default=16,
+                        help="Amount of requests waiting for a worker before new ones are rejected")
+    parser.add_argument("-m", "--max-memory",
+                        required=False,
+                        type=parse_size,
+                        default=0,
+                        help="Budget for work buffers kept by all workers together, e.g. 2G (0 keeps no buffers)")
+    return parser.parse_args()
+
+
+def make_request_parser():
+    # Requests accept the same pipeline parameters as the
+    # command line, passed as query parameters instead
+    parser = argparse.ArgumentParser(add_help=False, exit_on_error=False)
+    parser.add_argument("-f", "--format",
+                        required=False,
+                        type=ExportFormat,
+                        choices=list(ExportFormat),
+                        default=ExportFormat.JPG)
+    add_pipeline_arguments(parser)
+    return parser
+
+
+def parse_request_options(parser, query):
+    arguments = list()
+    for key, value in parse_qsl(query, keep_blank_values=True):
+        arguments.append(f"--{key}")
+        if value != "":
+            arguments.append(value)
+
+    try:
+        options, unknown = parser.parse_known_args(arguments)
+    except (argparse.ArgumentError, SystemExit) as error:
+        raise ValueError(f"Invalid parameters: {error}")
+
+    if unknown:
+        raise ValueError(f"Unknown parameters: {' '.join(unknown)}")
+    if options.tile_size > 0:
+        raise ValueError("Tiled processing is not available in service mode")
+
+    # Debug artifacts are never written by the service
+    # and it does not read masks from the file system
+    options.pyramid = max(1, options.pyramid)
+    options.density_floor = min(1.0, max(0.01, options.density_floor))
+    options.density_map = None
+    options.plot = False
+    options.export_contours = False
+    options.export_triangulation = False
+    return options
+
+
+def decode_image(data):
+    if data[:4] == b"qoif":
+        return qoi.decode(data), ChannelOrder.RGB
+
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Request body is not a supported image")
+
+    return image, ChannelOrder.BGR
+
+
+class LatencyHistogram:
+    def __init__(self, buckets):
+        # Latencies are recorded separately for
+        # each response status, e.g. 200 or 503
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.series = dict()
+
+    def observe(self, seconds, status):
+        with self.lock:
+            if status not in self.series:
+                self.series[status] = {"counts": [0] * len(self.buckets), "total": 0, "sum": 0.0}
+
+            series = self.series[status]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series["counts"][i] += 1
+            series["total"] += 1
+            series["sum"] += seconds
+
+    def to_prometheus(self, name):
+        with self.lock:
+            lines = [f"# TYPE {name} histogram"]
+            for status, series in sorted(self.series.items()):
+                for bound, count in zip(self.buckets, series["counts"]):
+                    lines.append(f'{name}_bucket{{status="{status}",le="{bound}"}} {count}')
+                lines.append(f'{name}_bucket{{status="{status}",le="+Inf"}} {series["total"]}')
+                lines.append(f'{name}_sum{{status="{status}"}} {series["sum"]}')
+                lines.append(f'{name}_count{{status="{status}"}} {series["total"]}')
+
+        return '\n'.join(lines) + '\n'
+
+
+class Service:
+    def __init__(self, workers, queue_size, max_memory=0):
+        # Requests are queued for a fixed amount of workers. Once
+        # the queue is full, requests are rejected right away
+        # instead of piling up (backpressure).
+        self.jobs = queue.Queue(maxsize=max(1, queue_size))
+        self.latency = LatencyHistogram(SERVICE_LATENCY_BUCKETS)
+        self.rejected = 0
+        self.rejected_lock = threading.Lock()
+        self.arenas = list()
+        workers = max(1, workers)
+        for _ in range(workers):
+            # Each worker reuses its own work buffers,
+            # sharing the memory budget equally
+            arena = BufferArena(max_memory // workers)
+            self.arenas.append(arena)
+            threading.Thread(target=self.work, args=(arena,), daemon=True).start()
+
+    def submit(self, image, order, options):
+        future = Future()
+        try:
+            self.jobs.put_nowait((future, image, order, options))
+        except queue.Full:
+            with self.rejected_lock:
+                self.rejected += 1
+            raise
+
+        return future
+
+    def work(self, arena):
+        while True:
+            future, image, order, options = self.jobs.get()
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(self.process(image, order, options, arena))
+                except Exception as error:
+                    future.set_exception(error)
+
+            self.jobs.task_done()
+
+    def process(self, image, order, options, arena=None):
+        # The result lives in the worker's buffers,
+        # which is why it is encoded right away
+        metrics = Instrumentation()
+        metrics.begin_image("request")
+        colorized_image = polygonize(image, order, "request", None, options, metrics, arena=arena)
+
+        metrics.begin("Encoding")
+        data = encode(colorized_image, options.format, order)
+        metrics.end()
+
+        metrics.end_image()
+        return data, metrics.records
+
+    def warm_up(self):
+        # Compiled numba functions are loaded from cache and
+        # libraries are initialized before the first request
+        generator = np.random.default_rng(0)
+        image = generator.integers(0, 256, size=SERVICE_WARMUP_SHAPE, dtype=np.uint8)
+        options = parse_request_options(make_request_parser(), "")
+        self.submit(image, ChannelOrder.BGR, options).result()
+
+    def to_prometheus(self):
+        text = self.latency.to_prometheus("plygn_request_duration_seconds")
+        text += "# TYPE plygn_request_queue_depth gauge\n"
+        text += f"plygn_request_queue_depth {self.jobs.qsize()}\n"
+        text += "# TYPE plygn_requests_rejected_total counter\n"
+        text += f"plygn_requests_rejected_total {self.rejected}\n"
+        text += "# TYPE plygn_buffer_bytes gauge\n"
+        text += f"plygn_buffer_bytes {sum(arena.size for arena in self.arenas)}\n"
+        text += "# TYPE plygn_rss_peak_bytes gauge\n"
+        text += f"plygn_rss_peak_bytes {get_peak_rss()}\n"
+        return text
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    request_parser = make_request_parser()
+
+    def address_string(self):
+        # Clients of Unix sockets do not have an address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+
+        return "local"
+
+    def respond(self, status, content_type, body, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or dict()).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def respond_text(self, status, text, headers=None):
+        self.respond(status, "text/plain; charset=utf-8", text.encode("utf-8"), headers)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/metrics":
+            self.respond_text(200, self.server.service.to_prometheus())
+        elif path == "/health":
+            self.respond_text(200, "ok\n")
+        else:
+            self.respond_text(404, "Not found\n")
+
+    def do_POST(self):
+        start = perf_counter_ns()
+        status = self.handle_process()
+        self.server.service.latency.observe((perf_counter_ns() - start) / 1e9, status)
+
+    def handle_process(self):
+        # The body is always consumed before responding, so that
+        # the next request on a kept-alive connection is parsed
+        # from where it starts. Without a valid length, where the
+        # body ends is unknown and the connection is closed.
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.close_connection = True
+            self.respond_text(400, "Invalid Content-Length\n")
+            return 400
+
+        body = self.rfile.read(length)
+        url = urlparse(self.path)
+        if url.path != "/process":
+            self.respond_text(404, "Not found\n")
+            return 404
+
+        try:
+            options = parse_request_options(self.request_parser, url.query)
+            image, order = decode_image(body)
+        except ValueError as error:
+            self.respond_text(400, f"{error}\n")
+            return 400
+
+        try:
+            future = self.server.service.submit(image, order, options)
+        except queue.Full:
+            self.respond_text(503, "Service is overloaded\n", {"Retry-After": "1"})
+            return 503
+
+        try:
+            data, records = future.result()
+        except Exception as error:
+            self.respond_text(500, f"Processing has failed: {error}\n")
+            return 500
+
+        # The stage metrics are handed back alongside the image,
+        # compacted into a single header line
+        metrics = to_json(records, indent=None)
+        self.respond(200, SERVICE_CONTENT_TYPES[options.format], data, {"X-Plygn-Metrics": metrics})
+        return 200
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(args):
+    if args.socket is not None:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        return UnixHTTPServer(args.socket, ServiceHandler)
+
+    return ThreadingHTTPServer(("127.0.0.1", args.port), ServiceHandler)
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    service = Service(args.workers, args.queue_size, args.max_memory)
+
+    print("Warming up...", end='\r')
+    service.warm_up()
+
+    server = make_server(args)
+    server.service = service
+    address = args.socket if args.socket is not None else f"127.0.0.1:{args.port}"
+    print(f"Serving on '{address}'".ljust(35))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        sys.exit(0)
+    finally:
+        server.server_close()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+import argparse
+import cv2
+import json
+import math
+import numpy as np
+import sys
+
+from clustering import *
+from colorization import *
+from colorspace import *
+from contouring import *
+from triangulation import *
+from utils import *
+from enum import Enum
+from time import perf_counter_ns
+
+STAGE_BENCHMARK_SEED = 42
+STAGE_BENCHMARK_ASPECT = 3 / 2
+STAGE_BENCHMARK_WARMUP_SIZE = 0.01
+
+
+class SyntheticImage(Enum):
+    GRADIENT = 'GRADIENT'
+    NOISE = 'NOISE'
+    FLAT = 'FLAT'
+    PHOTO = 'PHOTO'
+
+    def __str__(self):
+        return self.value
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-o", "--output",
+                        required=False,
+                        type=str,
+                        default=None,
+                        help="Path to result file")
+    parser.add_argument("-b", "--baseline",
+                        required=False,
+                        type=str,
+                        default=None,
+                        help="Path to baseline file for regression checks")
+    parser.add_argument("-t", "--tolerance",
+                        required=False,
+                        type=float,
+                        default=0.1,
+                        help="Relative throughput loss before a stage counts as regressed")
+    parser.add_argument("-m", "--megapixels",
+                        required=False,
+                        type=float,
+                        default=[0.5, 2, 12, 50],
+                        nargs='+',
+                        help="Synthetic image sizes in megapixels")
+    parser.add_argument("-i", "--images",
+                        required=False,
+                        type=SyntheticImage,
+                        choices=list(SyntheticImage),
+                        default=list(SyntheticImage),
+                        nargs='+',
+                        help="Synthetic image kinds")
+    parser.add_argument("-r", "--repeats",
+                        required=False,
+                        type=int,
+                        default=3,
+                        help="Repetitions per stage (fastest one is reported)")
+    parser.add_argument("-c", "--colorspace",
+                        required=False,
+                        type=ColorSpace,
+                        choices=list(ColorSpace),
+                        default=ColorSpace.RGB,
+                        help="Color space for clustering image data")
+    parser.add_argument("-d", "--distance",
+                        required=False,
+                        type=int,
+                        default=10,
+                        help="Preferred vertex distance")
+    parser.add_argument("-s", "--splitting",
+                        required=False,
+                        type=int,
+                        default=200,
+                        help="Maximum triangle area before splitting into smaller triangles")
+    parser.add_argument("-v", "--variance",
+                        required=False,
+                        type=float,
+                        default=-1.0,
+                        help="Maximum allowed color variance for a triangle to be drawn")
+    parser.add_argument("-n", "--noise-kernel",
+                        required=False,
+                        type=int,
+                        default=5,
+                        help="Kernel size for noise reduction on contours")
+    parser.add_argument("-k", "--kmeans",
+                        required=False,
+                        type=int,
+                        default=8,
+                        help="Centroid count for kmeans color clustering")
+    return parser.parse_args()
+
+
+# ==================================
+# ||      Synthetic Images        ||
+# ==================================
+def get_dimensions(megapixels):
+    pixels = megapixels * 1e6
+    height = max(1, int(math.sqrt(pixels / STAGE_BENCHMARK_ASPECT)))
+    width = max(1, int(height * STAGE_BENCHMARK_ASPECT))
+    return height, width
+
+
+def make_gradient(height, width, generator):
+    # Smooth diagonal gradients with a distinct
+    # direction for each channel
+    ys = np.linspace(0, 1, height, dtype=np.float32).reshape((-1, 1))
+    xs = np.linspace(0, 1, width, dtype=np.float32).reshape((1, -1))
+    r = np.broadcast_to(xs * 255, (height, width))
+    g = np.broadcast_to(ys * 255, (height, width))
+    b = (xs + ys) * 127.5
+    return np.uint8(np.dstack((r, g, b)))
+
+
+def make_noise(height, width, generator):
+    return generator.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+
+
+def make_flat(height, width, generator):
+    # Large uniformly colored regions
+    # on a coarse grid of random colors
+    blocks = generator.integers(0, 256, size=(8, 12, 3), dtype=np.uint8)
+    return cv2.resize(blocks, (width, height), interpolation=cv2.INTER_NEAREST)
+
+
+def make_photo(height, width, generator):
+    # Photo-like content consists of low frequency
+    # structures, some sharp edges and sensor noise
+    coarse = generator.integers(0, 256, size=(24, 36, 3), dtype=np.uint8)
+    image = cv2.resize(coarse, (width, height), interpolation=cv2.INTER_CUBIC).astype(np.int16)
+    edges = make_flat(height, width, generator).astype(np.int16)
+    image = (image + edges) // 2
+
+    noise = generator.normal(0, 4, size=(height, width, 3)).astype(np.int16)
+    return np.uint8(np.clip(image + noise, 0, 255))
+
+
+SYNTHETIC_GENERATORS = {
+    SyntheticImage.GRADIENT: make_gradient,
+    SyntheticImage.NOISE: make_noise,
+    SyntheticImage.FLAT: make_flat,
+    SyntheticImage.PHOTO: make_photo
+}
+
+
+def make_synthetic_image(kind, megapixels):
+    # Seeding with the same value each time makes
+    # the images reproducible between runs
+    generator = np.random.default_rng(STAGE_BENCHMARK_SEED)
+    height, width = get_dimensions(megapixels)
+    return SYNTHETIC_GENERATORS[kind](height, width, generator)
+
+
+# ==================================
+# ||      Stage Measurement       ||
+# ==================================
+def measure_stage(repeats, stage, *arguments):
+    # The fastest repetition is the one that
+    # is least disturbed by the rest of the system
+    fastest = None
+    result = None
+    for _ in range(max(1, repeats)):
+        start = perf_counter_ns()
+        result = stage(*arguments)
+        delta = (perf_counter_ns() - start) / 1e9
+        fastest = delta if fastest is None else min(fastest, delta)
+
+    return result, fastest
+
+
+def run_stages(image, args, repeats):
+    pixels = image.shape[0] * image.shape[1]
+    timings = dict()
+
+    (image_as_ints, unique_ints, unique_colors, unique_counts), timings["dedupe_colors"] = \
+        measure_stage(repeats, dedupe_colors, image)
+    points, timings["to_space"] = measure_stage(repeats, to_space, unique_colors, args.colorspace, unique_ints)
+
+    labels, timings["kmeans"] = measure_stage(repeats, kmeans, args.kmeans, points, unique_counts)
+    labels = expand_labels(image_as_ints, unique_ints, labels, image.shape)
+
+    contours, timings["find_contours"] = \
+        measure_stage(repeats, find_contours, args.kmeans, labels, args.noise_kernel)
+    vertices, timings["find_vertices"] = measure_stage(repeats, find_vertices, contours, args.distance)
+    triangulation, timings["find_triangulation"] = \
+        measure_stage(repeats, find_triangulation, image.shape, vertices)
+
+    if args.splitting > 0:
+        triangulation, timings["split_triangulation"] = \
+            measure_stage(repeats, split_triangulation, triangulation, args.splitting)
+
+    _, timings["colorize"] = measure_stage(repeats, colorize, image, triangulation, args.variance)
+
+    results = dict()
+    for stage, seconds in timings.items():
+        results[stage] = {
+            "seconds": seconds,
+            "megapixels_per_second": (pixels / 1e6) / seconds if seconds > 0 else math.inf
+        }
+
+    results["counts"] = {
+        "unique_colors": len(unique_ints),
+        "contours": sum(len(contour_group) for contour_group in contours),
+        "vertices": len(vertices),
+        "triangles": len(triangulation)
+    }
+    return results
+
+
+def run_benchmarks(args):
+    # Numba compiles its functions on the first call,
+    # which must not be accounted to the first stage
+    warmup = make_synthetic_image(SyntheticImage.PHOTO, STAGE_BENCHMARK_WARMUP_SIZE)
+    run_stages(warmup, args, 1)
+
+    results = dict()
+    for kind in args.images:
+        for megapixels in args.megapixels:
+            key = f"{kind}@{megapixels}MP"
+            print(f"Benchmarking '{key}'")
+            image = make_synthetic_image(kind, megapixels)
+            results[key] = run_stages(image, args, args.repeats)
+            for stage, result in results[key].items():
+                if stage == "counts":
+                    continue
+                print(f"> {stage}".ljust(35), f"{result['megapixels_per_second']:.3f} MP/s")
+
+    return results
+
+
+def find_regressions(results, baseline, tolerance):
+    regressions = list()
+    for key, stages in results.items():
+        if key not in baseline:
+            continue
+
+        for stage, result in stages.items():
+            if stage == "counts" or stage not in baseline[key]:
+                continue
+
+            current = result["megapixels_per_second"]
+            reference = baseline[key][stage]["megapixels_per_second"]
+            if current < reference * (1 - tolerance):
+                regressions.append((key, stage, reference, current))
+
+    return regressions
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    results = run_benchmarks(args)
+
+    if args.output is not None:
+        with open(args.output, "w+") as result_file:
+            json.dump(results, result_file, ensure_ascii=False, indent=4)
+            print("\nStage benchmarks have been written to:")
+            print(truncate_path(args.output, 3))
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as baseline_file:
+            baseline = json.load(baseline_file)
+
+        regressions = find_regressions(results, baseline, args.tolerance)
+        print(f"\n[ {len(regressions)} stage regressions have been found! ]")
+        for key, stage, reference, current in regressions:
+            print(f"> {key} {stage}".ljust(45), f"{reference:.3f} -> {current:.3f} MP/s")
+
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,165 @@
+import numpy as np
+
+from clustering import *
+from colorization import *
+from colorspace import *
+from contouring import *
+from triangulation import *
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+CANVAS_PATH = "{0}_canvas.npy"
+
+
+def find_tiles(shape, tile_size):
+    # The image is covered by non-overlapping core tiles,
+    # which are the regions that are eventually colorized
+    height, width = shape[:2]
+    tiles = list()
+    for y0 in range(0, height, tile_size):
+        for x0 in range(0, width, tile_size):
+            y1 = min(y0 + tile_size, height)
+            x1 = min(x0 + tile_size, width)
+            tiles.append((y0, y1, x0, x1))
+
+    return tiles
+
+
+def find_window(shape, tile, overlap):
+    # Contours are searched in a window reaching beyond the
+    # core tile, so that they are not cut off at its edges
+    height, width = shape[:2]
+    y0, y1, x0, x1 = tile
+    return max(0, y0 - overlap), min(height, y1 + overlap), max(0, x0 - overlap), min(width, x1 + overlap)
+
+
+def accumulate_histogram(histogram, image, order, tiles):
+    # Color frequencies are accumulated tile by tile,
+    # so that the whole image never has to be resident.
+    # Each unique color is only counted once per tile,
+    # which allows for plain fancy-index accumulation.
+    for y0, y1, x0, x1 in tiles:
+        tile_data = np.ascontiguousarray(image[y0:y1, x0:x1])
+        _, unique_ints, _, unique_counts = dedupe_colors(tile_data, order)
+        histogram[unique_ints] += unique_counts
+
+
+def to_histogram_colors(histogram):
+    unique_ints = np.flatnonzero(histogram).astype(np.int32)
+    unique_counts = histogram[unique_ints]
+    return unique_ints, to_colors(unique_ints), unique_counts
+
+
+def find_global_histogram(image, order, tiles):
+    histogram = np.zeros((256 ** 3), dtype=np.int64)
+    accumulate_histogram(histogram, image, order, tiles)
+    return to_histogram_colors(histogram)
+
+
+def find_global_palette(image, order, tiles, clusters, space, init=None, mode=PaletteMode.WARM):
+    # By default, given centroids warm-start clustering,
+    # whereas a shared palette skips clustering altogether
+    if init is not None and mode is PaletteMode.SHARED and len(init) == clusters:
+        return init, None
+
+    unique_ints, unique_colors, unique_counts = find_global_histogram(image, order, tiles)
+    translated_unique_colors = to_space(unique_colors, space, unique_ints)
+    centroids = find_palette(mode, clusters, translated_unique_colors, unique_counts, init)
+    return centroids, len(unique_ints)
+
+
+def find_seam_vertices(tile, distance):
+    # Seam vertices are placed on absolute positions that are
+    # multiples of the vertex distance. Hence, two neighbouring
+    # tiles place vertices on the same rows (or columns) along
+    # their shared edge and their triangulations line up.
+    y0, y1, x0, x1 = tile
+    height, width = y1 - y0, x1 - x0
+    vertices = list()
+    for y in range(y0 - (y0 % distance) + distance, y1 - 1, distance):
+        vertices.append((0, y - y0))
+        vertices.append((width - 1, y - y0))
+
+    for x in range(x0 - (x0 % distance) + distance, x1 - 1, distance):
+        vertices.append((x - x0, 0))
+        vertices.append((x - x0, height - 1))
+
+    return vertices
+
+
+def process_tile(image, order, tile, overlap, centroids, space, kernel_size, distance, splitting, variance):
+    # ==============================
+    # ||      Window Analysis     ||
+    # ==============================
+    wy0, wy1, wx0, wx1 = find_window(image.shape, tile, overlap)
+    window = np.ascontiguousarray(image[wy0:wy1, wx0:wx1])
+    image_as_ints, unique_ints, unique_colors, _ = dedupe_colors(window, order)
+
+    # Labels are assigned using the global palette,
+    # so that clusters are consistent across tiles
+    labels = assign_labels(centroids, to_space(unique_colors, space, unique_ints))
+    labels = expand_labels(image_as_ints, unique_ints, labels, window.shape)
+    contours = find_contours(len(centroids), labels, kernel_size)
+    vertices = find_vertices(contours, distance)
+    del window, image_as_ints, labels
+
+    # ======================================
+    # ||      Core Tile Triangulation     ||
+    # ======================================
+    # Only vertices strictly inside the core tile are kept,
+    # whereas its edges are covered by the seam vertices
+    y0, y1, x0, x1 = tile
+    core_vertices = list()
+    for x, y in vertices:
+        x, y = x + wx0 - x0, y + wy0 - y0
+        if 0 < x < (x1 - x0 - 1) and 0 < y < (y1 - y0 - 1):
+            core_vertices.append((x, y))
+
+    core_vertices += find_seam_vertices(tile, distance)
+    core = np.ascontiguousarray(image[y0:y1, x0:x1])
+    triangulation = find_triangulation(core.shape, core_vertices)
+    if splitting > 0:
+        triangulation = split_triangulation(triangulation, splitting)
+
+    colorized = colorize(core, triangulation, variance)
+    counts = {
+        "contours": sum(len(contour_group) for contour_group in contours),
+        "vertices": len(core_vertices),
+        "triangles": len(triangulation)
+    }
+    return tile, colorized, counts
+
+
+def process_tiles(image, order, canvas, canvas_order, tiles, workers, *arguments):
+    # Only a bounded amount of tiles is in flight at a time,
+    # so that peak memory depends on tile size and worker
+    # count, but not on the size of the image. Tiles are
+    # converted into the canvas order one at a time, so that
+    # the canvas never has to be converted as a whole.
+    counts = dict()
+    pending = set()
+    remaining = iter(tiles)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            while len(pending) < 2 * workers:
+                tile = next(remaining, None)
+                if tile is None:
+                    break
+                pending.add(executor.submit(process_tile, image, order, tile, *arguments))
+
+            if not pending:
+                break
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                (y0, y1, x0, x1), colorized, tile_counts = future.result()
+                canvas[y0:y1, x0:x1] = to_channel_order(colorized, order, canvas_order)
+                for name, value in tile_counts.items():
+                    counts[name] = counts.get(name, 0) + value
+
+    return counts
+
+
+def make_canvas(path, shape):
+    # The canvas is memory-mapped, so that colorized tiles
+    # are streamed to disk instead of being kept in memory
+    return np.lib.format.open_memmap(CANVAS_PATH.format(path), mode='w+', dtype=np.uint8, shape=shape)
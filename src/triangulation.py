@@ -2,13 +2,14 @@ import cv2
 import math
 import numpy as np
 
+from colorspace import ChannelOrder, to_channel_order
 from numba import njit
 
 TRIANGULATION_THICKNESS = 1
 TRIANGULATION_COLOR = (0, 255, 0)
 
 
-def find_vertices(contour_groups, preferred_distance):
+def find_vertices(contour_groups, preferred_distance, density=None):
     vertices = list()
     for contour_group in contour_groups:
         for contour in contour_group:
@@ -18,6 +19,10 @@ def find_vertices(contour_groups, preferred_distance):
             if length < 3:
                 continue
 
+            if density is not None:
+                vertices += find_weighted_vertices(contour, preferred_distance, density)
+                continue
+
             # Initially the vertex distance along a
             # contour line is equal to the preferred
             distance = preferred_distance
@@ -55,10 +60,84 @@ def find_vertices(contour_groups, preferred_distance):
     return vertices
 
 
+def find_weighted_vertices(contour, preferred_distance, density):
+    # Each step along the contour line only advances the walk
+    # by the local density, so that vertices are spaced further
+    # apart in regions of low density
+    points = contour.reshape((-1, 2))
+    progress = np.cumsum(density[points[:, 1], points[:, 0]])
+    total = progress[-1]
+
+    # Short contours still hold at least three vertices,
+    # which are distributed evenly along the walk
+    distance = preferred_distance if total >= 3 * preferred_distance else total / 3
+    vertex_count = max(1, math.floor(total / distance))
+    distance = total / vertex_count
+    indices = np.searchsorted(progress, distance * np.arange(1, vertex_count + 1) - 1e-6)
+    indices = np.unique(np.minimum(indices, len(points) - 1))
+    return [(int(x), int(y)) for x, y in points[indices]]
+
+
+def find_budgeted_vertices(contour_groups, preferred_distance, density=None, budget=0):
+    # A Delaunay triangulation of n vertices holds at most
+    # 2n - 5 triangles, where n includes the four corners
+    # added later on. As long as that exceeds the budget,
+    # vertices are searched again with a distance widened
+    # by the excess, until the count stops falling.
+    vertices = find_vertices(contour_groups, preferred_distance, density)
+    if budget <= 0:
+        return vertices
+
+    limit = max(1, (budget - 2) // 2 - 4)
+    distance = preferred_distance
+    while len(vertices) > limit:
+        distance = max(distance + 1, math.ceil(distance * len(vertices) / limit))
+        widened = find_vertices(contour_groups, distance, density)
+        if len(widened) >= len(vertices):
+            break
+        vertices = widened
+
+    # Every contour keeps at least three vertices, so that
+    # images with many small contours can still exceed the
+    # budget. Then, only the longest contours are kept.
+    if len(vertices) > limit:
+        contours = sorted((contour for contour_group in contour_groups for contour in contour_group), key=len, reverse=True)
+        vertices = list()
+        for contour in contours:
+            contour_vertices = find_vertices([[contour]], distance, density)
+            if len(vertices) + len(contour_vertices) > limit:
+                break
+            vertices += contour_vertices
+
+    return vertices
+
+
+def count_split_triangles(triangulation, thresholds):
+    x1, y1, x2, y2, x3, y3 = np.float64(triangulation.T)
+    sizes = np.abs((x1 * (y2 - y3) + x2 * (y3 - y1) + x3 * (y1 - y2)) * 0.5)
+    with np.errstate(divide='ignore'):
+        splits = np.ceil(np.log(sizes / thresholds) / np.log(4))
+    splits = np.maximum(splits, 0)
+    return int(np.sum(np.power(4.0, splits)))
+
+
+def fit_split_budget(triangulation, thresholds, budget):
+    # Raising all thresholds by a factor of four removes one
+    # split level from each triangle, until the budget is met
+    # or no triangle is split anymore
+    thresholds = np.full(len(triangulation), thresholds, dtype=np.float64)
+    limit = max(budget, len(triangulation))
+    while count_split_triangles(triangulation, thresholds) > limit:
+        thresholds *= 4
+
+    return thresholds
+
+
 @njit(cache=True, nogil=True)
 def split_triangulation(triangulation, threshold):
-    # The size of a triangle determines whether a
-    # triangle must be split into smaller triangles.
+    # The size of a triangle determines whether a triangle
+    # must be split into smaller triangles. The threshold is
+    # either shared by all triangles or given per triangle.
     x1, y1, x2, y2, x3, y3 = triangulation.T
     sizes = np.abs((x1 * (y2 - y3) + x2 * (y3 - y1) + x3 * (y1 - y2)) * 0.5)
     splits = np.ceil(np.log(sizes / threshold) / np.log(4)).astype(np.int32)
@@ -166,17 +245,11 @@ def find_triangulation(image_shape, vertices):
     return triangulation
 
 
-def export_triangulation(image, triangles, out_path):
-    result = image.copy()
-    for x1, y1, x2, y2, x3, y3 in triangles:
-        a = (x1, y1)
-        b = (x2, y2)
-        c = (x3, y3)
-        result = cv2.line(result, a, b, TRIANGULATION_COLOR, TRIANGULATION_THICKNESS)
-        result = cv2.line(result, b, c, TRIANGULATION_COLOR, TRIANGULATION_THICKNESS)
-        result = cv2.line(result, c, a, TRIANGULATION_COLOR, TRIANGULATION_THICKNESS)
-
-    cv2.imwrite(
-        f"{out_path}/triangulated.png",
-        cv2.cvtColor(result, cv2.COLOR_RGB2BGR)
-    )
+def export_triangulation(image, order, triangles, out_path):
+    # All triangles are drawn as closed polylines within a
+    # single call onto a copy in the encoder's BGR order
+    result = to_channel_order(image, order, ChannelOrder.BGR)
+    result = result.copy() if result is image else result
+    polygons = triangles.reshape((-1, 3, 2)).astype(np.int32)
+    cv2.polylines(result, polygons, True, TRIANGULATION_COLOR, TRIANGULATION_THICKNESS)
+    cv2.imwrite(f"{out_path}/triangulated.png", result)